@@ -1,8 +1,24 @@
 # agent_runner.py
 from pathlib import Path
+import os
+import sys
+import ast
+import builtins
+import tokenize
+import keyword
+import io
+import re
+import json
+import hashlib
+import importlib
 import time
+import random
 import argparse
-from openai import OpenAI
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
+from openai import OpenAI, DefaultHttpxClient, APIStatusError, APITimeoutError, APIConnectionError
 
 # ========================== UTIL FUNCTIONS ==========================
 def read_file(path: Path) -> str:
@@ -11,7 +27,7 @@ def read_file(path: Path) -> str:
 def write_file(path: Path, content: str):
     path.write_text(content, encoding="utf-8")
 
-def extract_imports(code: str) -> str:
+def extract_imports_by_lines(code: str) -> str:
     lines = code.splitlines()
     import_lines = []
     for line in lines:
@@ -21,7 +37,7 @@ def extract_imports(code: str) -> str:
         import_lines.append(line)
     return "\n".join(import_lines).strip()
 
-def extract_test_cases(code: str) -> list[str]:
+def extract_test_cases_by_lines(code: str) -> list[str]:
     lines = code.splitlines()
     test_cases = []
     i = 0
@@ -96,14 +112,1758 @@ def load_prompt_lines(prompt_file: Path) -> list[str]:
 
     return paragraphs
 
+# ========================== STEP CLASSIFICATION ==========================
+# Transformation kinds recognised in all_changes.txt paragraphs, by key phrase.
+STEP_KINDS = {
+    "literals": ("repeated literals", "magic values"),
+    "aaa": ("# arrange",),
+    "dict_asserts": ("dict-level asserts", "deep-equality"),
+    "rename_test": ("rename each test",),
+    "rename_vars": ("rename local variables",),
+    "dead_store": ("remove assignment",),
+    "comments": ("add comments", "intent:"),
+}
+
+def classify_step(change_prompt: str) -> str | None:
+    lowered = change_prompt.lower()
+    for kind, phrases in STEP_KINDS.items():
+        if any(phrase in lowered for phrase in phrases):
+            return kind
+    return None
+
+def step_kinds(change_prompt: str) -> set[str]:
+    # Every kind named in the prompt; a fused prompt names several.
+    lowered = change_prompt.lower()
+    return {kind for kind, phrases in STEP_KINDS.items() if any(phrase in lowered for phrase in phrases)}
+
+# ========================== EDIT OPERATIONS ==========================
+# Steps whose result is a small edit of the input; for these the model can
+# answer with an edit list instead of re-emitting the whole function.
+EDIT_STEP_KINDS = {"rename_test", "rename_vars", "dead_store"}
+
+EDIT_FORMAT = (
+    'Answer with a single JSON object and nothing else, using only the keys you need: '
+    '{"renames": {"old_name": "new_name"}, "delete_lines": [line numbers], '
+    '"replace_lines": {"line number": "new line text"}, "insert_after": {"line number": ["new line", ...]}}. '
+    'Line numbers refer to the numbered lines of the test; "renames" renames a function, parameter or '
+    'local variable everywhere in the test; new lines include their indentation; use "0" in '
+    '"insert_after" to insert before the first line.'
+)
+
+def number_lines(code: str) -> str:
+    return "\n".join(f"{i:>3}| {line}" for i, line in enumerate(code.splitlines(), start=1))
+
+def parse_edit_ops(response: str) -> dict | None:
+    try:
+        ops = json.loads(strip_markdown_fences(response))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(ops, dict) or set(ops) - {"renames", "delete_lines", "replace_lines", "insert_after"}:
+        return None
+    try:
+        return {
+            "renames": {str(k): str(v) for k, v in ops.get("renames", {}).items()},
+            "delete_lines": {int(n) for n in ops.get("delete_lines", [])},
+            "replace_lines": {int(n): str(text) for n, text in ops.get("replace_lines", {}).items()},
+            "insert_after": {int(n): [str(line) for line in lines]
+                             for n, lines in ops.get("insert_after", {}).items()},
+        }
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def rename_identifiers(code: str, renames: dict[str, str]) -> str:
+    # Rename functions, parameters and variables via their AST positions, so
+    # attributes, keyword arguments and strings with the same text stay untouched.
+    tree = ast.parse(code)
+    lines = code.splitlines()
+    positions = []  # (line, column, old name)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in renames:
+            positions.append((node.lineno, node.col_offset, node.id))
+        elif isinstance(node, ast.arg) and node.arg in renames:
+            positions.append((node.lineno, node.col_offset, node.arg))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name in renames:
+            line = lines[node.lineno - 1]
+            col = line.index(node.name, line.index("def") + 3)
+            positions.append((node.lineno, col, node.name))
+    # Column offsets are in UTF-8 bytes; edit right to left so earlier offsets stay valid.
+    for lineno, col, old in sorted(positions, reverse=True):
+        raw = lines[lineno - 1].encode("utf-8")
+        lines[lineno - 1] = (raw[:col] + renames[old].encode("utf-8") + raw[col + len(old.encode("utf-8")):]).decode("utf-8")
+    return "\n".join(lines)
+
+def identifier_names(tree: ast.AST) -> set[str]:
+    # Every variable, parameter and function name that appears in the tree.
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            names.add(node.name)
+    return names
+
+def local_bindings(tree: ast.AST) -> set[str]:
+    # Names the tree binds itself: assignment targets, parameters and functions.
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            names.add(node.name)
+    return names
+
+def apply_edit_ops(code: str, ops: dict) -> str | None:
+    # Apply an edit list to the original test. Returns None if the edit refers
+    # to lines that do not exist, does not parse, leaves names unbound that the
+    # original bound, renames names the test does not bind itself, or renames
+    # to invalid names, to names the test already uses (unless those are
+    # renamed away too), or merges two names into one.
+    try:
+        original = ast.parse(code)
+    except SyntaxError:
+        return None
+    if not set(ops["renames"]) <= local_bindings(original):
+        return None  # module aliases and imported names are bound outside the test
+    lines = code.splitlines()
+    touched = ops["delete_lines"] | set(ops["replace_lines"]) | set(ops["insert_after"])
+    if any(not 0 <= n <= len(lines) for n in touched) or 0 in ops["delete_lines"] | set(ops["replace_lines"]):
+        return None
+    targets = list(ops["renames"].values())
+    if not all(new.isidentifier() for new in targets) or len(set(targets)) < len(targets):
+        return None
+
+    edited = ops["insert_after"].get(0, [])[:]
+    for n, line in enumerate(lines, start=1):
+        if n not in ops["delete_lines"]:
+            edited.append(ops["replace_lines"].get(n, line))
+        edited.extend(ops["insert_after"].get(n, []))
+    result = "\n".join(edited)
+    try:
+        if ops["renames"]:
+            kept = identifier_names(ast.parse(result)) - set(ops["renames"])
+            if kept & set(targets):
+                return None
+            result = rename_identifiers(result, ops["renames"])
+        if unbound_names(ast.parse(result)) - unbound_names(original):
+            return None
+    except SyntaxError:
+        return None
+    return result
+
+# ========================== LOCAL TRANSFORMATIONS ==========================
+# Deterministic AST-driven rewrites for mechanical steps. They edit the source
+# text at AST positions, so everything they do not touch keeps its formatting.
+STEP_ENGINES = ("llm", "local", "local-then-llm")
+
+def apply_text_edits(code: str, edits: list[tuple[int, int, int, int, str]]) -> str:
+    # Replace (line, col, end_line, end_col) spans, with AST-style 1-based lines
+    # and UTF-8 byte columns, by new text. Spans must not overlap.
+    raw = code.encode("utf-8")
+    line_starts = [0]
+    for line in raw.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+    for line, col, end_line, end_col, text in sorted(edits, reverse=True):
+        start, end = line_starts[line - 1] + col, line_starts[end_line - 1] + end_col
+        raw = raw[:start] + text.encode("utf-8") + raw[end:]
+    return raw.decode("utf-8")
+
+def test_functions(tree: ast.AST) -> list[ast.FunctionDef | ast.AsyncFunctionDef]:
+    return [n for n in ast.walk(tree)
+            if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef)) and n.name.startswith("test")]
+
+def is_pure_expression(node: ast.expr) -> bool:
+    # Literals, names and containers of those: evaluating them has no side effects.
+    if isinstance(node, (ast.Constant, ast.Name)):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return is_pure_expression(node.operand)
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return all(is_pure_expression(e) for e in node.elts)
+    if isinstance(node, ast.Dict):
+        return all(k is None or is_pure_expression(k) for k in node.keys) and all(map(is_pure_expression, node.values))
+    return False
+
+NAMESPACE_READERS = {"locals", "vars", "eval", "exec"}
+
+def find_dead_stores(func: ast.FunctionDef | ast.AsyncFunctionDef) -> list[ast.Assign]:
+    # Single-name assignments whose value is never read afterwards. `x += 1`
+    # and `del x` count as reads. Stores inside loops are skipped (a later
+    # iteration may read them), as are names read by nested functions or
+    # lambdas, global/nonlocal names, and every store in a function that
+    # looks at its namespace through locals(), vars(), eval() or exec().
+    if any(isinstance(n, ast.Call) and isinstance(n.func, ast.Name) and n.func.id in NAMESPACE_READERS
+           for n in ast.walk(func)):
+        return []
+    augmented = {id(n.target) for n in ast.walk(func) if isinstance(n, ast.AugAssign)}
+    loads = [n for n in ast.walk(func)
+             if isinstance(n, ast.Name) and (isinstance(n.ctx, (ast.Load, ast.Del)) or id(n) in augmented)]
+    declared = {name for n in ast.walk(func) if isinstance(n, (ast.Global, ast.Nonlocal)) for name in n.names}
+    in_loops = {id(n) for loop in ast.walk(func) if isinstance(loop, (ast.For, ast.AsyncFor, ast.While))
+                for n in ast.walk(loop)}
+    nested_reads = {n.id for inner in ast.walk(func)
+                    if inner is not func and isinstance(inner, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda))
+                    for n in ast.walk(inner) if isinstance(n, ast.Name)}
+    dead = []
+    for node in ast.walk(func):
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)
+                and id(node) not in in_loops and node.targets[0].id not in nested_reads | declared):
+            name = node.targets[0].id
+            end = (node.end_lineno, node.end_col_offset)
+            if not any(n.id == name and (n.lineno, n.col_offset) > end for n in loads):
+                dead.append(node)
+    return dead
+
+def statement_blocks(tree: ast.AST) -> dict[int, list[ast.stmt]]:
+    # Map id(statement) to the statement list that holds it (a body, orelse,
+    # finalbody, or an except handler's / match case's body).
+    blocks = {}
+    for node in ast.walk(tree):
+        for name in ("body", "orelse", "finalbody"):
+            block = getattr(node, name, None)
+            if isinstance(block, list):
+                for stmt in block:
+                    blocks[id(stmt)] = block
+    return blocks
+
+def remove_dead_stores(code: str) -> str:
+    # "Remove assignment that not be used": drop dead stores of side-effect free
+    # values, and keep the call (without the assignment) when the value has effects.
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code
+    blocks = statement_blocks(tree)
+    removed = {}  # id(block) -> statements removed from it
+    lines = code.splitlines()
+    edits = []
+    for func in test_functions(tree):
+        for node in find_dead_stores(func):
+            if is_pure_expression(node.value):
+                block = blocks.get(id(node), [])
+                if removed.get(id(block), 0) + 1 >= len(block):
+                    continue  # removing it would leave an empty block
+                line = lines[node.lineno - 1]
+                if line[:node.col_offset].strip() or lines[node.end_lineno - 1][node.end_col_offset:].strip():
+                    continue  # shares its line with other code
+                removed[id(block)] = removed.get(id(block), 0) + 1
+                edits.append((node.lineno, 0, node.end_lineno + 1, 0, ""))
+            else:
+                # Drop only "name =" so brackets around the value stay intact.
+                target = node.targets[0]
+                rest = lines[target.end_lineno - 1].encode("utf-8")[target.end_col_offset:]
+                match = re.match(rb"\s*=(?!=)\s*", rest)
+                if match is None or match.end() == len(rest):
+                    continue  # "=" or the value is on a continuation line
+                edits.append((node.lineno, node.col_offset, target.end_lineno,
+                              target.end_col_offset + match.end(), ""))
+    if not edits:
+        return code
+    # Deleting whole lines may reach past the last line; pad so the offsets exist.
+    result = apply_text_edits(code if code.endswith("\n") else code + "\n", edits)
+    result = result if code.endswith("\n") else result.rstrip("\n")
+    try:
+        ast.parse(result)  # the local engine's output may never reach the LLM
+    except SyntaxError:
+        return code
+    return result
+
+def literal_value(node: ast.expr):
+    # Value of an extractable literal (str/bytes/int/float, optionally negated), else None.
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = literal_value(node.operand)
+        return -value if isinstance(value, (int, float)) else None
+    if (isinstance(node, ast.Constant) and type(node.value) in (str, bytes, int, float)
+            and node.value not in ("", b"", 0, 1, -1)):
+        return node.value
+    return None
+
+def literal_name(value, taken: set[str]) -> str:
+    if isinstance(value, (str, bytes)):
+        text = value.decode("utf-8", "replace") if isinstance(value, bytes) else value
+        words = re.findall(r"[a-z0-9]+", text.lower())[:4]
+        base = "_".join(words) if words and not words[0][0].isdigit() else ""
+        base = f"{'bytes' if isinstance(value, bytes) else 'text'}_{base}" if base else ("bytes_value" if isinstance(value, bytes) else "text_value")
+    else:
+        number = str(abs(value)).replace(".", "_").replace("-", "_").replace("+", "")
+        base = f"{type(value).__name__}_{'minus_' if value < 0 else ''}{number}"
+    name, n = base[:40], 2
+    while name in taken:
+        name, n = f"{base[:40]}_{n}", n + 1
+    taken.add(name)
+    return name
+
+def extract_repeated_literals(code: str, min_count: int = 2) -> str:
+    # "Extract repeated literals into named constants": every literal that occurs
+    # at least `min_count` times in a test body becomes a lowercase_snake_case
+    # constant declared at the top of that body. A literal that already is the
+    # whole value of a top-level "name = literal" (name assigned only once) is
+    # not redeclared: later occurrences reuse that name. f-string fragments,
+    # docstrings and trivial values (0, 1, -1, "") are left alone.
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code
+    lines = code.splitlines()
+    edits = []
+    for func in test_functions(tree):
+        body = func.body
+        if isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) and isinstance(body[0].value.value, str):
+            body = body[1:]  # keep the docstring first
+        if not body:
+            continue
+        skip = {id(n) for node in ast.walk(func) if isinstance(node, ast.JoinedStr) for n in ast.walk(node)}
+        skip |= {id(n) for node in func.args.defaults + func.args.kw_defaults + func.decorator_list
+                 if node is not None for n in ast.walk(node)}
+        occurrences = {}
+        for stmt in body:
+            for node in ast.walk(stmt):
+                if id(node) in skip:
+                    continue
+                value = literal_value(node)
+                if value is not None:
+                    # Negative literals are matched as a whole; do not count their operand again.
+                    if isinstance(node, ast.UnaryOp):
+                        skip.add(id(node.operand))
+                    occurrences.setdefault((type(value), value), []).append(node)
+        repeated = {key: nodes for key, nodes in occurrences.items() if len(nodes) >= min_count}
+        if not repeated:
+            continue
+        stores = [n.id for n in ast.walk(func) if isinstance(n, ast.Name) and not isinstance(n.ctx, ast.Load)]
+        existing = {id(stmt.value): stmt for stmt in body
+                    if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                    and isinstance(stmt.targets[0], ast.Name) and stores.count(stmt.targets[0].id) == 1}
+        taken = {n.id for n in ast.walk(tree) if isinstance(n, ast.Name)} | {a.arg for a in ast.walk(func) if isinstance(a, ast.arg)}
+        indent = lines[body[0].lineno - 1][:body[0].col_offset]
+        declarations = []
+        for (_, value), nodes in sorted(repeated.items(), key=lambda item: (item[1][0].lineno, item[1][0].col_offset)):
+            definition = next((existing[id(n)] for n in nodes if id(n) in existing), None)
+            if definition is not None:
+                name, end = definition.targets[0].id, (definition.end_lineno, definition.end_col_offset)
+                edits += [(n.lineno, n.col_offset, n.end_lineno, n.end_col_offset, name)
+                          for n in nodes if (n.lineno, n.col_offset) > end]
+                continue
+            name = literal_name(value, taken)
+            declarations.append(f"{indent}{name} = {ast.get_source_segment(code, nodes[0])}\n")
+            edits += [(n.lineno, n.col_offset, n.end_lineno, n.end_col_offset, name) for n in nodes]
+        if declarations:
+            edits.append((body[0].lineno, 0, body[0].lineno, 0, "".join(declarations)))
+    if not edits:
+        return code
+    result = apply_text_edits(code, edits)
+    try:
+        ast.parse(result)
+    except SyntaxError:
+        return code
+    return result
+
+def step_engine_arg(value: str) -> tuple[int, str]:
+    # argparse type for "--step_engine 6=local": step number and engine.
+    step, _, engine = value.partition("=")
+    if not step.isdigit() or engine not in STEP_ENGINES:
+        raise argparse.ArgumentTypeError(f"expected <step>=<{'|'.join(STEP_ENGINES)}>, got {value!r}")
+    return int(step), engine
+
+LOCAL_TRANSFORMS = {
+    "dead_store": remove_dead_stores,
+    "literals": extract_repeated_literals,
+}
+
+def local_transform(test_case: str, change_prompt: str, engine: str) -> tuple[str, bool]:
+    # Run the local engine for this step if it has one. Returns the (possibly)
+    # transformed test and whether the step is complete without the LLM.
+    transform = LOCAL_TRANSFORMS.get(classify_step(change_prompt))
+    if engine == "llm" or transform is None:
+        return test_case, False
+    return transform(test_case), engine == "local"
+
+# ========================== APPLICABILITY PREFILTER ==========================
+# Cheap static predicates telling whether a step can change a test at all.
+# Tests for which the predicate is False skip the LLM call and pass through.
+GENERATED_NAME_RE = re.compile(r"^[a-z]+(_[a-z]+)*_\d+$")  # Pynguin style: int_0, queue_0
+GENERIC_TEST_NAME_RE = re.compile(r"(^test_case|_case\b|check|_\d+$)")
+
+def has_repeated_literals(tree: ast.AST, code: str) -> bool:
+    return extract_repeated_literals(code) != code
+
+def has_field_by_field_dict_asserts(tree: ast.AST, code: str) -> bool:
+    # Two consecutive asserts that both subscript (or .get()) the same object.
+    def asserted_container(stmt: ast.stmt) -> str | None:
+        if not isinstance(stmt, ast.Assert):
+            return None
+        for node in ast.walk(stmt.test):
+            if isinstance(node, ast.Subscript):
+                return ast.dump(node.value)
+            if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and node.func.attr == "get"):
+                return ast.dump(node.func.value)
+        return None
+
+    for node in ast.walk(tree):
+        body = getattr(node, "body", None)
+        if isinstance(body, list):
+            containers = [asserted_container(stmt) for stmt in body]
+            if any(a is not None and a == b for a, b in zip(containers, containers[1:])):
+                return True
+    return False
+
+def has_dead_stores(tree: ast.AST, code: str) -> bool:
+    return any(find_dead_stores(func) for func in test_functions(tree))
+
+def lacks_aaa_sections(tree: ast.AST, code: str) -> bool:
+    return not all(marker in code for marker in ("# Arrange", "# Act", "# Assert"))
+
+def lacks_intent_comment(tree: ast.AST, code: str) -> bool:
+    return "# Intent:" not in code
+
+def has_generic_test_name(tree: ast.AST, code: str) -> bool:
+    return any(GENERIC_TEST_NAME_RE.search(func.name) for func in test_functions(tree))
+
+def has_generated_variable_names(tree: ast.AST, code: str) -> bool:
+    return any(isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store) and GENERATED_NAME_RE.match(n.id)
+               for n in ast.walk(tree))
+
+STEP_PREDICATES = {
+    "literals": has_repeated_literals,
+    "aaa": lacks_aaa_sections,
+    "dict_asserts": has_field_by_field_dict_asserts,
+    "rename_test": has_generic_test_name,
+    "rename_vars": has_generated_variable_names,
+    "dead_store": has_dead_stores,
+    "comments": lacks_intent_comment,
+}
+
+def step_applies(test_case: str, change_prompt: str) -> bool:
+    # Unknown steps and code that does not parse are always sent to the model.
+    predicate = STEP_PREDICATES.get(classify_step(change_prompt))
+    if predicate is None:
+        return True
+    try:
+        tree = ast.parse(test_case)
+    except SyntaxError:
+        return True
+    return predicate(tree, test_case)
+
+# ========================== STRUCTURAL DEDUPLICATION ==========================
+# Generated suites contain many tests that differ only in literal values and
+# local names. Such tests share a fingerprint; one representative per cluster
+# is sent to the LLM and its rewrite is replayed onto the other members.
+@dataclass
+class TestShape:
+    fingerprint: str
+    literals: list = field(default_factory=list)  # (type, value) in traversal order
+    names: list[str] = field(default_factory=list)  # local names in traversal order
+    tests: list[str] = field(default_factory=list)  # sorted test function names
+    identifiers: set[str] = field(default_factory=set)  # every NAME token of the test
+
+def dedup_literal(node: ast.AST):
+    # (type, value) of an abstractable literal, including negated numbers, else None.
+    if (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant)
+            and type(node.operand.value) in (int, float)):
+        return type(node.operand.value), -node.operand.value
+    if isinstance(node, ast.Constant) and type(node.value) in (str, bytes, int, float, bool):
+        return type(node.value), node.value
+    return None
+
+def local_names(tree: ast.AST) -> set[str]:
+    # Test function names, their parameters and every name they assign.
+    names = set()
+    for func in test_functions(tree):
+        names.add(func.name)
+        names |= {a.arg for a in ast.walk(func.args) if isinstance(a, ast.arg)}
+        names |= {n.id for n in ast.walk(func) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+    return names
+
+class ShapeAbstractor(ast.NodeTransformer):
+    # Replace literals and local names by placeholders, recording the originals.
+    def __init__(self, local: set[str]):
+        self.local = local
+        self.shape = TestShape("")
+
+    def abstract_name(self, name: str) -> str:
+        if name not in self.local:
+            return name
+        if name not in self.shape.names:
+            self.shape.names.append(name)
+        return f"_n{self.shape.names.index(name)}"
+
+    def visit_UnaryOp(self, node):
+        literal = dedup_literal(node)
+        if literal is None:
+            return self.generic_visit(node)
+        self.shape.literals.append(literal)
+        return ast.Constant(value="_lit")
+
+    def visit_Constant(self, node):
+        literal = dedup_literal(node)
+        if literal is None:
+            return node  # None and Ellipsis stay structural
+        self.shape.literals.append(literal)
+        return ast.Constant(value="_lit")
+
+    def visit_JoinedStr(self, node):
+        return node  # f-string fragments have no usable positions; keep them structural
+
+    def visit_Name(self, node):
+        return ast.Name(id=self.abstract_name(node.id), ctx=node.ctx)
+
+    def visit_arg(self, node):
+        node.arg = self.abstract_name(node.arg)
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        node.name = self.abstract_name(node.name)
+        return self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+def test_shape(code: str) -> TestShape | None:
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    abstractor = ShapeAbstractor(local_names(tree))
+    normalized = abstractor.visit(tree)
+    abstractor.shape.fingerprint = hashlib.sha256(ast.dump(normalized).encode("utf-8")).hexdigest()
+    abstractor.shape.tests = sorted(f.name for f in test_functions(ast.parse(code)))
+    abstractor.shape.identifiers = {tok.string for tok in tokenize.generate_tokens(io.StringIO(code).readline)
+                                    if tok.type == tokenize.NAME}
+    return abstractor.shape
+
+def cluster_tests(items: list[tuple[int, str]]) -> list[list[tuple[int, str, TestShape | None]]]:
+    # Group (index, test) pairs by fingerprint, keeping first-seen order.
+    # Unparsable tests each form their own cluster.
+    clusters = {}
+    for i, code in items:
+        shape = test_shape(code)
+        key = shape.fingerprint if shape is not None else f"unparsable-{i}"
+        clusters.setdefault(key, []).append((i, code, shape))
+    return list(clusters.values())
+
+def count_asserts(tree: ast.AST) -> int:
+    return sum(isinstance(n, ast.Assert) for n in ast.walk(tree))
+
+def literal_text_re(literal) -> re.Pattern | None:
+    # Pattern for a literal's value written out in a comment or identifier,
+    # e.g. 1256 in "# capacity 1256" or "queue_1256".
+    kind, value = literal
+    if kind in (int, float):
+        return re.compile(rf"(?<![0-9.]){re.escape(repr(abs(value)))}(?![0-9])")
+    text = value.decode("latin-1") if kind is bytes else str(value)
+    if not text.strip():
+        return None
+    return re.compile(rf"(?<![A-Za-z0-9]){re.escape(text)}(?![A-Za-z0-9])")
+
+def mentions_replaced_literal(code: str, known_identifiers: set[str], literal_map: dict) -> bool:
+    # True if a comment or an identifier the rewrite introduced spells out a
+    # representative value that the member replaces by another one. Only AST
+    # literals are replayed, so such text would describe the wrong test.
+    patterns = [p for p in map(literal_text_re, literal_map) if p is not None]
+    for tok in tokenize.generate_tokens(io.StringIO(code).readline):
+        if tok.type == tokenize.COMMENT or (tok.type == tokenize.NAME and tok.string not in known_identifiers
+                                            and not keyword.iskeyword(tok.string)):
+            if any(p.search(tok.string) for p in patterns):
+                return True
+    return False
+
+def replay_rewrite(rep: TestShape, rep_output: str, member: TestShape) -> str | None:
+    # Rewrite the representative's output for a member of its cluster by mapping
+    # the representative's literals and local names to the member's. Returns None
+    # when the mapping is ambiguous, the result fails the parse/assert checks, or
+    # a comment or new name still carries a representative value.
+    literal_map, name_map = {}, dict(zip(rep.names, member.names))
+    for rep_literal, member_literal in zip(rep.literals, member.literals):
+        if literal_map.setdefault(rep_literal, member_literal) != member_literal:
+            return None  # one representative value stands for two member values
+    literal_map = {k: v for k, v in literal_map.items() if k != v}
+    rep_output = strip_markdown_fences(rep_output)
+    try:
+        tree = ast.parse(rep_output)
+    except SyntaxError:
+        return None
+
+    edits, inner = [], set()
+    in_fstrings = {id(n) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for n in ast.walk(node)}
+    for node in ast.walk(tree):
+        literal = dedup_literal(node)
+        if literal in literal_map and id(node) not in inner and id(node) not in in_fstrings:
+            if isinstance(node, ast.UnaryOp):
+                inner.add(id(node.operand))
+            edits.append((node.lineno, node.col_offset, node.end_lineno, node.end_col_offset,
+                          repr(literal_map[literal][1])))
+    try:
+        replayed = apply_text_edits(rep_output, edits)
+        renames = {old: new for old, new in name_map.items() if old != new}
+        if renames:
+            replayed = rename_identifiers(replayed, renames)
+        replayed_tree = ast.parse(replayed)
+        if mentions_replaced_literal(replayed, rep.identifiers | member.identifiers, literal_map):
+            return None
+    except (SyntaxError, ValueError, tokenize.TokenError):
+        return None
+
+    # Every representative-only value must be gone and the asserts must line up.
+    # A rewrite that renamed the test cannot be replayed: the copies would collide.
+    member_literals = set(member.literals)
+    leftover = {dedup_literal(n) for n in ast.walk(replayed_tree)} & set(literal_map)
+    if leftover - member_literals or count_asserts(replayed_tree) != count_asserts(tree):
+        return None
+    if sorted(f.name for f in test_functions(replayed_tree)) != member.tests:
+        return None
+    return replayed
+
+# ========================== CONTEXT COMPACTION ==========================
+MINIFY_MODES = ("none", "strip", "summary", "api")
+
+def docstring_node(node: ast.AST) -> ast.Expr | None:
+    body = getattr(node, "body", None)
+    if (isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) and body
+            and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant)
+            and isinstance(body[0].value.value, str)):
+        return body[0]
+    return None
+
+def is_private_name(name: str) -> bool:
+    return name.startswith("_") and not (name.startswith("__") and name.endswith("__"))
+
+def minify_module_source(source: str, mode: str) -> str:
+    # Shrink a module for the system prompt without changing what it does:
+    #   strip   - drop docstrings, comments and blank lines
+    #   summary - like strip, but keep the first line of every docstring
+    #   api     - like strip, and also drop private (_name) functions, classes and methods
+    # Docstrings are cut by their exact AST span and blank lines or trailing
+    # spaces inside string literals are kept. Code that does not parse, or
+    # would not parse after compaction, is returned unchanged.
+    if mode == "none":
+        return source
+    try:
+        tree = ast.parse(source)
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    except (SyntaxError, tokenize.TokenError):
+        return source
+
+    lines = source.splitlines()
+
+    def byte_col(lineno: int, col: int) -> int:
+        return len(lines[lineno - 1][:col].encode("utf-8"))
+
+    def on_own_lines(node: ast.AST, start_line: int) -> bool:
+        # Nothing but indentation before it and at most a comment after it.
+        before = lines[start_line - 1].encode("utf-8")[:node.col_offset if start_line == node.lineno else 0]
+        after = lines[node.end_lineno - 1].encode("utf-8")[node.end_col_offset:].strip()
+        return not before.strip() and (not after or after.startswith(b"#"))
+
+    scopes = [n for n in ast.walk(tree)
+              if isinstance(n, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef))]
+
+    removed = {}  # id(statement) -> first line, for private definitions dropped in api mode
+    if mode == "api":
+        for node in scopes:
+            for child in node.body:
+                if (isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+                        and is_private_name(child.name)):
+                    start = min([d.lineno for d in child.decorator_list] + [child.lineno])
+                    if on_own_lines(child, start):
+                        removed[id(child)] = start
+    inside_removed = {id(n) for node in scopes if id(node) in removed for n in ast.walk(node)}
+    scopes = [n for n in scopes if id(n) not in inside_removed]
+    docs = {id(scope): docstring_node(scope) for scope in scopes if docstring_node(scope) is not None}
+
+    edits, deleted_lines = [], set()
+
+    def delete_lines(start: int, end: int, placeholder: str = ""):
+        edits.append((start, 0, end + 1, 0, placeholder))
+        deleted_lines.update(range(start, end + 1))
+
+    for scope in scopes:
+        # A class or function whose whole body goes away still needs a statement.
+        emptied = not isinstance(scope, ast.Module) and all(
+            id(stmt) in removed or stmt is docs.get(id(scope)) for stmt in scope.body)
+        doc = docs.get(id(scope))
+        if doc is not None:
+            summary = doc.value.value.strip().splitlines()[0].strip() if doc.value.value.strip() else ""
+            span = (doc.lineno, doc.col_offset, doc.end_lineno, doc.end_col_offset)
+            if mode == "summary" and summary:
+                edits.append(span + (repr(summary),))
+            elif emptied:
+                edits.append(span + ("...",))
+            elif on_own_lines(doc, doc.lineno):
+                delete_lines(doc.lineno, doc.end_lineno)
+            else:
+                # Shares its line with the header or a following "; statement".
+                rest = lines[doc.end_lineno - 1].encode("utf-8")[doc.end_col_offset:]
+                separator = re.match(rb"\s*;\s*", rest)
+                edits.append((doc.lineno, doc.col_offset, doc.end_lineno,
+                              doc.end_col_offset + (separator.end() if separator else 0), ""))
+            emptied = False
+        for stmt in scope.body:
+            if id(stmt) in removed:
+                indent = lines[stmt.lineno - 1][:stmt.col_offset]
+                delete_lines(removed[id(stmt)], stmt.end_lineno, f"{indent}...\n" if emptied else "")
+                emptied = False
+
+    for tok in tokens:
+        row = tok.start[0]
+        if tok.type == tokenize.COMMENT and row not in deleted_lines:
+            code_end = len(lines[row - 1][:tok.start[1]].rstrip())
+            edits.append((row, byte_col(row, code_end), row, byte_col(row, len(lines[row - 1])), ""))
+
+    # Deleting whole lines may reach past the last line; pad so the offsets exist.
+    result = apply_text_edits(source if source.endswith("\n") else source + "\n", edits)
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(result).readline))
+    except (SyntaxError, tokenize.TokenError):
+        return source
+    # Lines that end inside a multi-line string keep their blank lines and spaces.
+    in_string = {row for tok in tokens if tok.type == tokenize.STRING
+                 for row in range(tok.start[0], tok.end[0])}
+    compact = [line if lineno in in_string else line.rstrip()
+               for lineno, line in enumerate(result.splitlines(), start=1)
+               if lineno in in_string or line.strip()]
+    compact = "\n".join(compact)
+    try:
+        ast.parse(compact)
+    except SyntaxError:
+        return source
+    return compact
+
+# ========================== CONTEXT SLICING ==========================
+class ContextSlicer:
+    # Per-test slice of the modules under test. Every top-level statement of a
+    # module is indexed by the names it binds, together with the names it
+    # reads. A test seeds the slice with every name or attribute it mentions
+    # that a module defines (module_0.is_slug -> is_slug); the slice is then
+    # closed transitively over module-level references (is_email ->
+    # ESCAPED_AT_SIGN), following `from <other module under test> import x`
+    # into the other module. Segments keep source order, so identical slices
+    # produce byte-identical prompts.
+
+    def __init__(self, modules: dict[str, str]):
+        self.sources = {}
+        self.definitions = {}  # (file name, name) -> (first line, last line, names read)
+        self.module_imports = {}  # (file name, name) -> (other file name, name there)
+        stems = {Path(file_name).stem: file_name for file_name in modules}
+        for file_name, source in modules.items():
+            try:
+                tree = ast.parse(source)
+            except SyntaxError:
+                continue
+            self.sources[file_name] = source.splitlines()
+            for node in tree.body:
+                start = min([d.lineno for d in getattr(node, "decorator_list", [])] + [node.lineno])
+                reads = {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+                reads |= {n.attr for n in ast.walk(node) if isinstance(n, ast.Attribute)}
+                for name in bound_names(node):
+                    self.definitions[(file_name, name)] = (start, node.end_lineno, reads)
+                if isinstance(node, ast.ImportFrom) and node.module:
+                    other = stems.get(node.module.rsplit(".", 1)[-1])
+                    if other is not None and other != file_name:
+                        for alias in node.names:
+                            self.module_imports[(file_name, alias.asname or alias.name)] = (other, alias.name)
+
+    def select(self, code: str) -> dict[str, set[tuple[int, int]]]:
+        # Map each module to the line spans of the definitions `code` depends on.
+        try:
+            tree = ast.parse(code)
+            used = {n.id for n in ast.walk(tree) if isinstance(n, ast.Name)}
+            used |= {n.attr for n in ast.walk(tree) if isinstance(n, ast.Attribute)}
+        except SyntaxError:
+            used = set(re.findall(r"[A-Za-z_]\w*", code))
+
+        pending = [(file_name, name) for file_name in self.sources for name in used]
+        seen, spans = set(), {}
+        while pending:
+            key = pending.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            if key in self.module_imports:
+                pending.append(self.module_imports[key])
+            if key not in self.definitions:
+                continue
+            start, end, reads = self.definitions[key]
+            spans.setdefault(key[0], set()).add((start, end))
+            pending += [(key[0], name) for name in reads]
+        return spans
+
+    def context_for(self, code: str) -> str:
+        parts = []
+        for file_name, spans in self.select(code).items():
+            lines = self.sources[file_name]
+            segments = ["\n".join(lines[start - 1:end]) for start, end in sorted(spans)]
+            parts.append(f"# --- from {file_name} ---\n" + "\n".join(segments))
+        if not parts:
+            return ""
+        return "Relevant code from the modules under test:\n" + "\n\n".join(parts) + "\n\n"
+
+# ========================== SEMANTIC ANALYSIS ==========================
+SEMANTICS_VERSION = "1"  # bump when the analyzer output changes, to invalidate cached summaries
+
+BRANCH_NODES = {ast.If: "if", ast.For: "for", ast.AsyncFor: "for", ast.While: "while",
+                ast.Try: "try", ast.With: "with", ast.AsyncWith: "with", ast.Match: "match"}
+
+def literal_type(node: ast.AST) -> str | None:
+    if isinstance(node, ast.Constant):
+        return type(node.value).__name__
+    for node_type, name in ((ast.List, "list"), (ast.ListComp, "list"), (ast.Tuple, "tuple"),
+                            (ast.Set, "set"), (ast.SetComp, "set"), (ast.Dict, "dict"),
+                            (ast.DictComp, "dict"), (ast.JoinedStr, "str"), (ast.Compare, "bool")):
+        if isinstance(node, node_type):
+            return name
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id[:1].isupper():
+        return node.func.id  # constructor of a custom class
+    return None
+
+def summarize_function(func: ast.FunctionDef | ast.AsyncFunctionDef, qualname: str) -> list[str]:
+    # Control flow, def-use chains, statement purposes and variable roles of one function.
+    params = [a for a in func.args.posonlyargs + func.args.args + func.args.kwonlyargs]
+    params += [a for a in (func.args.vararg, func.args.kwarg) if a is not None]
+    header = f"FUNCTION {qualname}({', '.join(a.arg for a in params)}) [lines {func.lineno}-{func.end_lineno}]"
+
+    landmarks, exits = [], []
+    purposes = dict.fromkeys(["ASSIGN", "RETURN", "CALL", "ASSERT", "RAISE", "TRY_EXCEPT"], 0)
+
+    def visit(node: ast.AST, depth: int):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+                continue  # nested scopes are summarized on their own
+            kind = BRANCH_NODES.get(type(child))
+            if kind:
+                landmarks.append(f"{kind}@{child.lineno}(depth {depth})")
+            if isinstance(child, (ast.Return, ast.Raise)):
+                exits.append(f"{'return' if isinstance(child, ast.Return) else 'raise'}@{child.lineno}")
+            if isinstance(child, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+                purposes["ASSIGN"] += 1
+            elif isinstance(child, ast.Return):
+                purposes["RETURN"] += 1
+            elif isinstance(child, ast.Assert):
+                purposes["ASSERT"] += 1
+            elif isinstance(child, ast.Raise):
+                purposes["RAISE"] += 1
+            elif isinstance(child, ast.Try):
+                purposes["TRY_EXCEPT"] += 1
+            elif isinstance(child, ast.Call):
+                purposes["CALL"] += 1
+            visit(child, depth + 1 if kind else depth)
+
+    visit(func, 0)
+
+    defs, uses, types, roles = {}, {}, {}, {}
+    for a in params:
+        defs.setdefault(a.arg, []).append(func.lineno)
+        roles[a.arg] = "argument"
+        if a.annotation is not None:
+            types[a.arg] = ast.unparse(a.annotation)
+    condition_names = set()
+    for node in ast.walk(func):
+        if isinstance(node, (ast.If, ast.While)):
+            condition_names |= {n.id for n in ast.walk(node.test) if isinstance(n, ast.Name)}
+        elif isinstance(node, (ast.For, ast.AsyncFor, ast.comprehension)):
+            for n in ast.walk(node.target):
+                if isinstance(n, ast.Name):
+                    roles.setdefault(n.id, "temp")
+        elif isinstance(node, (ast.With, ast.AsyncWith)):
+            for item in node.items:
+                if isinstance(item.optional_vars, ast.Name):
+                    roles.setdefault(item.optional_vars.id, "resource_handle")
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                if (isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name)
+                        and target.value.id == "self"):
+                    roles[f"self.{target.attr}"] = "state_field"
+                    value_type = literal_type(node.value) if node.value is not None else None
+                    if value_type:
+                        types.setdefault(f"self.{target.attr}", value_type)
+                elif isinstance(target, ast.Name) and node.value is not None:
+                    value_type = literal_type(node.value)
+                    if isinstance(node, ast.AnnAssign):
+                        value_type = ast.unparse(node.annotation)
+                    if value_type:
+                        types.setdefault(target.id, value_type)
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Store):
+                defs.setdefault(node.id, []).append(node.lineno)
+            elif node.id in defs:
+                uses.setdefault(node.id, []).append(node.lineno)
+
+    returned = sorted({n.id for r in ast.walk(func) if isinstance(r, ast.Return) and r.value is not None
+                       for n in ast.walk(r.value) if isinstance(n, ast.Name) and n.id in defs})
+    chains = []
+    for name, lines in defs.items():
+        role = roles.setdefault(name, "control_flag" if name in condition_names and types.get(name) == "bool"
+                                else "computation")
+        source = "param" if role == "argument" else f"def {','.join(map(str, sorted(set(lines))))}"
+        used = ",".join(map(str, sorted(set(uses.get(name, []))))) or "unused"
+        chains.append(f"{name} ({source}) -> {used}")
+
+    lines = [header]
+    lines.append(f"  CONTROL_FLOW: {', '.join(landmarks) or 'straight-line'}; "
+                 f"entry@{func.lineno}, exits: {', '.join(exits) or f'fall-through@{func.end_lineno}'}")
+    if chains:
+        lines.append(f"  DATA_FLOW: {'; '.join(chains)}"
+                     + (f"; flows to return: {', '.join(returned)}" if returned else ""))
+    lines.append("  PURPOSE: " + ", ".join(f"{tag} x{count}" for tag, count in purposes.items() if count))
+    if roles:
+        lines.append("  ROLES: " + "; ".join(f"{name}: {role}" + (f" ({types[name]})" if name in types else "")
+                                             for name, role in roles.items()))
+    return lines
+
+def analyze_module_semantics(source: str) -> str:
+    # Static-analysis counterpart of the hand-written prompts/semantic_analysis_mut.txt:
+    # one block per function or method with control-flow landmarks, def-use
+    # chains, statement purposes and variable roles/types.
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        return f"(module could not be analyzed: {e})"
+    blocks = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            blocks.append(summarize_function(node, node.name))
+        elif isinstance(node, ast.ClassDef):
+            bases = ", ".join(ast.unparse(b) for b in node.bases)
+            blocks.append([f"CLASS {node.name}({bases}) [lines {node.lineno}-{node.end_lineno}]"])
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    blocks.append(summarize_function(item, f"{node.name}.{item.name}"))
+    constants = [t.id for n in tree.body if isinstance(n, (ast.Assign, ast.AnnAssign))
+                 for t in (n.targets if isinstance(n, ast.Assign) else [n.target])
+                 if isinstance(t, ast.Name)]
+    if constants:
+        blocks.insert(0, [f"MODULE CONSTANTS: {', '.join(constants)}"])
+    return "\n".join("\n".join(block) for block in blocks)
+
+def load_module_semantics(sources: dict[str, str], cache_dir: Path) -> str:
+    # Generated semantic summaries of all modules, cached on disk by content
+    # hash so a module is only re-analyzed after it changes. Cache misses are
+    # analyzed in a process pool.
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    summaries, misses = {}, {}
+    for name, source in sources.items():
+        digest = hashlib.sha256(f"{SEMANTICS_VERSION}\0{source}".encode("utf-8")).hexdigest()
+        cached = cache_dir / f"{digest}.txt"
+        if cached.exists():
+            summaries[name] = read_file(cached)
+        else:
+            misses[name] = cached
+
+    if misses:
+        with ProcessPoolExecutor() as pool:
+            for (name, cached), summary in zip(misses.items(),
+                                               pool.map(analyze_module_semantics, [sources[n] for n in misses])):
+                write_file(cached, summary)
+                summaries[name] = summary
+    print(f"Semantic analysis: {len(sources) - len(misses)} cached, {len(misses)} analyzed")
+
+    return "\n\n".join(f"SEMANTIC SUMMARY OF {name} (generated by static analysis):\n{summaries[name]}"
+                       for name in sources)
+
+# ========================== TEST PARSING ==========================
+@dataclass
+class TestUnit:
+    # One top-level test (a test_* function or a Test* class) with its decorators.
+    name: str
+    kind: str  # "function" or "class"
+    decorators: list[str]
+    start_line: int  # 1-based, first decorator line included
+    end_line: int
+    source: str
+    dependencies: list[str] = field(default_factory=list)  # module-level names it uses
+
+def is_test_node(node: ast.stmt) -> bool:
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return node.name.startswith("test")
+    return isinstance(node, ast.ClassDef) and node.name.startswith("Test")
+
+def bound_names(node: ast.stmt) -> set[str]:
+    # Names a top-level statement binds in the module namespace.
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return {(a.asname or a.name).split(".")[0] for a in node.names if a.name != "*"}
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+
+def parse_test_module(code: str) -> tuple[str, list[TestUnit]]:
+    # Split a test module into its preamble (imports, constants, fixtures,
+    # helpers; everything that is not a test, in source order) and its test
+    # units. Raises SyntaxError for code that does not parse.
+    tree = ast.parse(code)
+    lines = code.splitlines()
+    module_names = set()
+    for node in tree.body:
+        if not is_test_node(node):
+            module_names |= bound_names(node)
+
+    preamble, units = "", []
+    previous_import = False
+    for node in tree.body:
+        start = min([d.lineno for d in getattr(node, "decorator_list", [])] + [node.lineno])
+        source = "\n".join(lines[start - 1:node.end_lineno])
+        if not is_test_node(node):
+            # Keep import groups tight and separate everything else by a blank line.
+            is_import = isinstance(node, (ast.Import, ast.ImportFrom))
+            separator = "\n" if is_import and previous_import else "\n\n"
+            preamble += (separator if preamble else "") + source
+            previous_import = is_import
+            continue
+        used = {n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)}
+        units.append(TestUnit(
+            name=node.name,
+            kind="class" if isinstance(node, ast.ClassDef) else "function",
+            decorators=[ast.get_source_segment(code, d) for d in node.decorator_list],
+            start_line=start,
+            end_line=node.end_lineno,
+            source=source,
+            dependencies=sorted(used & module_names),
+        ))
+    return preamble, units
+
+def parse_test_file(path: Path) -> tuple[str, list[TestUnit]]:
+    return parse_test_module(read_file(path))
+
+def parse_test_directory(directory: Path, pattern: str = "test_*.py",
+                         max_workers: int | None = None) -> dict[Path, tuple[str, list[TestUnit]] | None]:
+    # Parse every matching test file below `directory` in a process pool.
+    # Files that do not parse map to None.
+    paths = sorted(directory.rglob(pattern))
+    parsed = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for path, future in zip(paths, [pool.submit(parse_test_file, p) for p in paths]):
+            try:
+                parsed[path] = future.result()
+            except SyntaxError as e:
+                print(f"{path} does not parse ({e}), falling back to line scanning")
+                parsed[path] = None
+    return parsed
+
+def extract_imports(code: str) -> str:
+    try:
+        return parse_test_module(code)[0]
+    except SyntaxError:
+        return extract_imports_by_lines(code)
+
+def extract_test_cases(code: str) -> list[str]:
+    try:
+        return [unit.source for unit in parse_test_module(code)[1]]
+    except SyntaxError:
+        # LLM output that does not parse still gets split on a best-effort basis.
+        return extract_test_cases_by_lines(code)
+
+def merge_preamble(import_block: str, code: str) -> str:
+    # Carry top-level non-test content that a step added to the file (helpers,
+    # fixtures, constants, imports) over into the preamble, since only the test
+    # units are split out for the next step. Names the preamble already binds
+    # keep their original definition.
+    try:
+        tree, known_tree = ast.parse(code), ast.parse(import_block)
+    except SyntaxError:
+        return import_block
+    known = set().union(*(bound_names(node) for node in known_tree.body))
+    lines = code.splitlines()
+    imports, additions = set(), []
+    for node in tree.body:
+        if is_test_node(node):
+            continue
+        start = min([d.lineno for d in getattr(node, "decorator_list", [])] + [node.lineno])
+        source = "\n".join(lines[start - 1:node.end_lineno])
+        names = bound_names(node)
+        if source in import_block or (names and names <= known):
+            continue
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imports.add(source)
+        else:
+            additions.append(source)
+        known |= names
+    import_block = extend_import_block(import_block, imports)
+    return "\n\n".join([import_block] + additions) if additions else import_block
+
+# ========================== LOCAL REPAIR ==========================
+BUILTIN_NAMES = set(dir(builtins))
+
+def strip_markdown_fences(code: str) -> str:
+    # Models sometimes wrap code in ```python fences despite being told not to.
+    stripped = code.strip()
+    if stripped.startswith("```"):
+        stripped = stripped.split("\n", 1)[1] if "\n" in stripped else ""
+        if stripped.rstrip().endswith("```"):
+            stripped = stripped.rstrip()[:-3]
+    return stripped.strip()
+
+def unbound_names(tree: ast.AST) -> set[str]:
+    # Names read somewhere in the tree but never bound in it (scope-insensitive).
+    loaded, bound = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (loaded if isinstance(node.ctx, ast.Load) else bound).add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound |= bound_names(node)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+    return loaded - bound - BUILTIN_NAMES
+
+class ImportResolver:
+    # Turns names a rewritten test uses but never binds into import statements,
+    # resolved against the test file's import block and the modules under test:
+    #   validation -> import string_utils.validation as validation  (module imported under an alias)
+    #   Queue      -> from queue_example import Queue               (top-level name of a module under test)
+    #   re, pytest -> import re                                     (standard library / pytest)
+    # A standard library module is only imported when the test uses the name
+    # purely as a module (re.compile(...)) with attributes that module has, and
+    # the name is not a lowercased name from the modules under test: a leftover
+    # "queue.size" after renaming queue_0 must not bind the stdlib queue module.
+
+    def __init__(self, import_block: str, module_sources: dict[str, str]):
+        try:
+            tree = ast.parse(import_block)
+        except SyntaxError:
+            tree = ast.Module(body=[], type_ignores=[])
+        self.known_names = set()
+        self.imported_modules = []
+        for node in tree.body:
+            self.known_names |= bound_names(node)
+            if isinstance(node, ast.Import):
+                self.imported_modules += [a.name for a in node.names]
+        self.module_exports = {}
+        for stem, source in module_sources.items():
+            try:
+                self.module_exports[stem] = set().union(*[bound_names(n) for n in ast.parse(source).body])
+            except SyntaxError:
+                continue
+        self.local_like = {n.lower() for names in self.module_exports.values() for n in names}
+        self.local_like |= {n.lower() for n in self.known_names}
+
+    def stdlib_module_fits(self, name: str, attributes: set[str] | None) -> bool:
+        if not attributes or name in self.local_like:
+            return False
+        try:
+            module = importlib.import_module(name)
+        except Exception:
+            return False
+        return all(hasattr(module, attribute) for attribute in attributes)
+
+    def resolve(self, name: str, attributes: set[str] | None = None) -> str | None:
+        # `attributes`: the attributes the test reads on `name`, or None when
+        # the name is also used on its own (called, compared, passed...).
+        for module in self.imported_modules:
+            if module.rsplit(".", 1)[-1] == name:
+                return f"import {module} as {name}" if module != name else f"import {module}"
+        for module in self.imported_modules:
+            if name in self.module_exports.get(module.rsplit(".", 1)[-1], ()):
+                return f"from {module} import {name}"
+        if name == "pytest" or (name in sys.stdlib_module_names and self.stdlib_module_fits(name, attributes)):
+            return f"import {name}"
+        return None
+
+def check_test_function(code: str, resolver: ImportResolver) -> tuple[set[str], bool]:
+    # Compile one rewritten test and collect the imports it is missing.
+    # Returns (imports to add, ok); ok is False when the code does not compile
+    # or uses a name that cannot be resolved.
+    try:
+        tree = ast.parse(code)
+        compile(tree, "<test>", "exec")
+    except (SyntaxError, ValueError):
+        return set(), False
+    attribute_bases = {id(n.value) for n in ast.walk(tree)
+                       if isinstance(n, ast.Attribute) and isinstance(n.value, ast.Name)}
+    attributes, bare = {}, set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            attributes.setdefault(node.value.id, set()).add(node.attr)
+        elif isinstance(node, ast.Name) and id(node) not in attribute_bases:
+            bare.add(node.id)
+    imports = set()
+    for name in unbound_names(tree) - resolver.known_names:
+        statement = resolver.resolve(name, None if name in bare else attributes.get(name))
+        if statement is None:
+            return set(), False
+        imports.add(statement)
+    return imports, True
+
+ASSERT_MERGING_KINDS = {"dict_asserts"}  # steps that may legitimately fold asserts together
+
+def called_apis(tree: ast.AST) -> set[str]:
+    # Names of the functions and methods a test calls, builtins excluded.
+    # Only the last component counts, so renamed receivers still match.
+    calls = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute):
+                calls.add(node.func.attr)
+            elif isinstance(node.func, ast.Name) and node.func.id not in BUILTIN_NAMES:
+                calls.add(node.func.id)
+    return calls
+
+def passes_local_checks(original: str, candidate: str, change_prompt: str = "") -> bool:
+    # Cheap acceptance test for a rewritten test: it parses, keeps the number
+    # of asserts (or folds them, for steps that merge asserts) and calls the
+    # same APIs as the original.
+    try:
+        before, after = ast.parse(original), ast.parse(strip_markdown_fences(candidate))
+    except SyntaxError:
+        return False
+    asserts_before, asserts_after = count_asserts(before), count_asserts(after)
+    if step_kinds(change_prompt) & ASSERT_MERGING_KINDS:
+        if asserts_after > asserts_before or (asserts_before and not asserts_after):
+            return False
+    elif asserts_after != asserts_before:
+        return False
+    return called_apis(after) == called_apis(before)
+
+# ========================== RATE LIMITING ==========================
+def estimate_tokens(text: str) -> int:
+    # Cheap tokenizer-free estimate: ~4 characters per token for English/code.
+    return max(1, len(text) // 4)
+
+def estimate_message_tokens(messages: list[dict]) -> int:
+    # Chat format adds a few tokens of framing per message.
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages) + 2
+
+def parse_reset_duration(value: str) -> float:
+    # Convert OpenAI reset headers such as "1s", "6m0s" or "250ms" into seconds.
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""):
+        seconds += float(amount) * units[unit]
+    return seconds
+
+class RateLimiter:
+    # Paces calls against requests-per-minute and tokens-per-minute budgets.
+    # Both budgets refill continuously (token bucket). Each call reserves its
+    # estimated token cost up front; the reservation is corrected with the real
+    # usage afterwards. The limit headers of every response replace the
+    # configured budgets with the account's real ones, and the remaining-quota
+    # headers clamp the local view so we never drift above what the server
+    # will accept.
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_allowance = float(rpm)
+        self.token_allowance = float(tpm)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_allowance = min(self.rpm, self.request_allowance + elapsed * self.rpm / 60.0)
+        self.token_allowance = min(self.tpm, self.token_allowance + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens: int):
+        # Block until one request and `tokens` tokens fit into the budgets.
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.request_allowance >= 1 and self.token_allowance >= tokens:
+                    self.request_allowance -= 1
+                    self.token_allowance -= tokens
+                    return
+                else:
+                    wait = max((1 - self.request_allowance) * 60.0 / self.rpm,
+                               (tokens - self.token_allowance) * 60.0 / self.tpm)
+            time.sleep(max(wait, 0.01))
+
+    def settle(self, estimated_tokens: int, actual_tokens: int | None):
+        # Refund (or charge) the difference between the reservation and real usage.
+        if actual_tokens is None:
+            return
+        with self.lock:
+            self.token_allowance = min(self.tpm, self.token_allowance + estimated_tokens - actual_tokens)
+
+    def update_from_headers(self, headers):
+        # Adopt the server-reported limits as budgets (raising them as well as
+        # lowering them), clamp the allowances to the remaining quota and pause
+        # entirely until the reset time once either quota is exhausted.
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit_requests is not None and float(limit_requests) > 0:
+                self.rpm = int(float(limit_requests))
+                self.request_allowance = min(self.request_allowance, float(self.rpm))
+            if limit_tokens is not None and float(limit_tokens) > 0:
+                self.tpm = int(float(limit_tokens))
+                self.token_allowance = min(self.token_allowance, float(self.tpm))
+            if remaining_requests is not None:
+                self.request_allowance = min(self.request_allowance, float(remaining_requests))
+                if float(remaining_requests) < 1:
+                    reset = parse_reset_duration(headers.get("x-ratelimit-reset-requests", ""))
+                    self.blocked_until = max(self.blocked_until, now + reset)
+            if remaining_tokens is not None:
+                self.token_allowance = min(self.token_allowance, float(remaining_tokens))
+                if float(remaining_tokens) < 1:
+                    reset = parse_reset_duration(headers.get("x-ratelimit-reset-tokens", ""))
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+# ========================== ADAPTIVE CONCURRENCY ==========================
+def is_overload_error(error: Exception) -> bool:
+    # 429s, 5xx responses and timeouts all mean "back off".
+    if isinstance(error, APITimeoutError):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class AIMDController:
+    # Additive-increase / multiplicative-decrease window on in-flight requests.
+    # Every successful call adds 1/window, i.e. the window grows by one per
+    # window's worth of completions while p95 latency stays near its baseline.
+    # A 429/5xx/timeout, or a call slower than `spike_factor` times the baseline
+    # p95, multiplies the window by `decrease`. Decreases are spaced by at least
+    # one baseline p95 so a burst of failures from the same window cuts only once.
+
+    def __init__(self, max_window: int, min_window: int = 1, increase: float = 1.0,
+                 decrease: float = 0.5, spike_factor: float = 2.0, sample_size: int = 50):
+        self.max_window = max_window
+        self.min_window = min_window
+        self.window = float(min(max_window, max(min_window, 2)))
+        self.increase = increase
+        self.decrease = decrease
+        self.spike_factor = spike_factor
+        self.latencies = deque(maxlen=sample_size)
+        self.baseline_p95 = None
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.window):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float | None, overloaded: bool = False):
+        with self.cond:
+            self.in_flight -= 1
+            previous = int(self.window)
+            if latency is not None and not overloaded:
+                self.latencies.append(latency)
+            p95 = percentile(self.latencies, 0.95) if self.latencies else None
+            spike = (latency is not None and self.baseline_p95 is not None
+                     and latency > self.spike_factor * self.baseline_p95)
+
+            if overloaded or spike:
+                now = time.monotonic()
+                if now - self.last_decrease >= (self.baseline_p95 or 1.0):
+                    self.window = max(self.min_window, self.window * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.window = min(self.max_window, self.window + self.increase / self.window)
+                # The baseline slowly follows p95 so a permanently busier
+                # backend does not keep triggering decreases.
+                if p95 is not None and len(self.latencies) >= 10:
+                    self.baseline_p95 = p95 if self.baseline_p95 is None else 0.9 * self.baseline_p95 + 0.1 * p95
+
+            if int(self.window) != previous:
+                p95_text = f"{p95:.2f}s" if p95 is not None else "n/a"
+                print(f"[AIMD] window {previous} -> {int(self.window)} (p95 {p95_text}, in flight {self.in_flight})")
+            self.cond.notify_all()
+
+# ========================== REQUEST HEDGING ==========================
+class HedgePolicy:
+    # Online latency quantile plus a budget for duplicate requests. A request
+    # still running after the `quantile` latency of recent calls gets one
+    # duplicate, as long as hedges stay below `max_ratio` of all requests.
+    # Until `min_samples` latencies are known, nothing is hedged.
+
+    def __init__(self, quantile: float = 0.95, max_ratio: float = 0.1,
+                 min_samples: int = 20, sample_size: int = 200):
+        self.quantile = quantile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=sample_size)
+        self.requests = 0
+        self.hedged = 0
+        self.backup_wins = 0
+        self.lock = threading.Lock()
+
+    def threshold(self) -> float | None:
+        with self.lock:
+            self.requests += 1
+            if len(self.latencies) < self.min_samples:
+                return None
+            return percentile(self.latencies, self.quantile)
+
+    def record(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def try_hedge(self) -> bool:
+        with self.lock:
+            if self.hedged + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def backup_won(self):
+        with self.lock:
+            self.backup_wins += 1
+
+    def stats(self) -> str:
+        with self.lock:
+            share = self.hedged / self.requests if self.requests else 0.0
+            return f"{self.hedged}/{self.requests} requests hedged ({share:.0%}), {self.backup_wins} won by the duplicate"
+
+# ========================== RESILIENCE ==========================
+def is_retryable_error(error: Exception) -> bool:
+    # Overload signals and dropped connections are worth retrying; other 4xx
+    # responses (bad request, auth, not found) will fail the same way again.
+    return is_overload_error(error) or isinstance(error, APIConnectionError)
+
+def retry_after_seconds(error: Exception) -> float:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else 0.0
+    except ValueError:
+        return 0.0
+
+class RetryPolicy:
+    # Exponential backoff with full jitter: attempt k sleeps a random time in
+    # [0, min(max_delay, base_delay * 2**k)], or at least the server's
+    # Retry-After. No attempt starts or runs past `deadline` seconds from the
+    # first one; each attempt's timeout is the remaining time.
+
+    def __init__(self, max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 30.0,
+                 deadline: float = 300.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(backoff, retry_after_seconds(error))
+
+class CircuitBreaker:
+    # Pauses dispatch when recent calls fail too often: once at least
+    # `min_calls` of the last `window` calls are known and `failure_ratio` of
+    # them failed, the breaker opens for `cooldown` seconds and every caller
+    # waits. It then closes with a fresh window.
+
+    def __init__(self, window: int = 20, min_calls: int = 10, failure_ratio: float = 0.5,
+                 cooldown: float = 30.0):
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                remaining = self.open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def record(self, success: bool):
+        with self.lock:
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self.outcomes):
+                print(f"[Circuit] open for {self.cooldown:.0f}s ({failures}/{len(self.outcomes)} recent calls failed)")
+                self.open_until = time.monotonic() + self.cooldown
+                self.outcomes.clear()
+
+# ========================== HTTP CLIENT ==========================
+# The HTTP library the installed SDK is built on (httpx for openai 1.x, httpx2
+# for later releases). Limits and timeouts must come from the same library as
+# DefaultHttpxClient, so take it from that class instead of importing one.
+http_lib = sys.modules[next(c for c in DefaultHttpxClient.__mro__
+                            if c.__name__ == "Client").__module__.partition(".")[0]]
+
+class ConnectionStats:
+    # Counts requests against newly opened connections through the trace
+    # extension of the client's transport (httpcore or httpcore2 emit the same
+    # events), so connection reuse can be checked: with a well sized pool and
+    # keep-alive, new connections stay near the concurrency level.
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.lock = threading.Lock()
+
+    def on_request(self, request):
+        with self.lock:
+            self.requests += 1
+        request.extensions["trace"] = self.trace
+
+    def trace(self, event_name: str, info: dict):
+        with self.lock:
+            if event_name == "connection.connect_tcp.complete":
+                self.connections += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+
+    def report(self) -> str:
+        with self.lock:
+            reused = 1 - self.connections / self.requests if self.requests else 0.0
+            return (f"{self.requests} requests over {self.connections} new connections "
+                    f"({self.tls_handshakes} TLS handshakes, {reused:.0%} reused)")
+
+_shared_http_clients = {}
+_shared_http_clients_lock = threading.Lock()
+
+def shared_http_client(max_connections: int = 20, max_keepalive: int = 20, keepalive_expiry: float = 60.0,
+                       http2: bool = False, connect_timeout: float = 10.0,
+                       read_timeout: float = 120.0) -> tuple[DefaultHttpxClient, ConnectionStats]:
+    # One explicitly sized client per configuration and process, so every
+    # agent (and every test suite in a directory run) reuses the same pool.
+    # DefaultHttpxClient keeps the SDK's defaults for everything not set here.
+    # http2=True needs the optional `h2` package.
+    key = (max_connections, max_keepalive, keepalive_expiry, http2, connect_timeout, read_timeout)
+    with _shared_http_clients_lock:
+        if key not in _shared_http_clients:
+            stats = ConnectionStats()
+            client = DefaultHttpxClient(
+                limits=http_lib.Limits(max_connections=max_connections,
+                                       max_keepalive_connections=max_keepalive,
+                                       keepalive_expiry=keepalive_expiry),
+                timeout=http_lib.Timeout(read_timeout, connect=connect_timeout),
+                http2=http2,
+                event_hooks={"request": [stats.on_request]},
+            )
+            _shared_http_clients[key] = (client, stats)
+        return _shared_http_clients[key]
+
+# ========================== STREAMING ==========================
+# Streamed answers are checked while they arrive, so a bad answer is dropped
+# after a few tokens instead of after the whole completion.
+CODE_START_RE = re.compile(r"^(def |async def |class |@|#|import |from |\{|\"{3}|'{3})")
+STREAM_CANCELLED = "cancelled"  # stream problem of a request closed by its caller
+RUNAWAY_FACTOR = 3  # abort once the answer is this many times the expected size...
+RUNAWAY_MIN_TOKENS = 100  # ...counting tiny tests as this size, since comments may double them
+
+def stream_problem(text: str, expected_completion_tokens: int) -> str | None:
+    # Why a partial answer should be abandoned, or None while it looks fine.
+    head = text.lstrip()
+    if head.startswith("```"):
+        return "markdown fence"
+    if "\n" in head and not CODE_START_RE.match(head):
+        return "prose preamble"
+    if estimate_tokens(text) > RUNAWAY_FACTOR * max(expected_completion_tokens, RUNAWAY_MIN_TOKENS):
+        return "runaway output"
+    return None
+
+class StreamStats:
+    # Time to first token and generation speed of every streamed call.
+
+    def __init__(self):
+        self.ttfts = []
+        self.rates = []
+        self.aborted = 0
+        self.lock = threading.Lock()
+
+    def record(self, ttft: float | None, tokens_per_second: float | None, aborted: bool):
+        with self.lock:
+            if ttft is not None:
+                self.ttfts.append(ttft)
+            if tokens_per_second is not None:
+                self.rates.append(tokens_per_second)
+            self.aborted += aborted
+
+    def report(self) -> str:
+        with self.lock:
+            if not self.ttfts:
+                return f"no tokens received, {self.aborted} aborted"
+            rate = f", {percentile(self.rates, 0.5):.0f} tokens/s median" if self.rates else ""
+            return (f"{len(self.ttfts)} calls, time to first token p50 {percentile(self.ttfts, 0.5):.2f}s "
+                    f"p95 {percentile(self.ttfts, 0.95):.2f}s{rate}, {self.aborted} aborted early")
+
+# ========================== RESPONSE CACHE ==========================
+class ResponseCache:
+    # Content-addressed on-disk cache of completions. Each entry is a file named
+    # by the sha256 of (model, temperature, system prompt, user message). The
+    # file mtime is the LRU clock: hits touch it, and the least recently used
+    # entries are evicted once the directory grows past `max_bytes`.
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.total_bytes = sum(f.stat().st_size for f in self.cache_dir.glob("*.txt"))
+
+    @staticmethod
+    def make_key(model: str, temperature: float, system_prompt: str, user_msg: str) -> str:
+        payload = json.dumps([model, temperature, system_prompt, user_msg], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        path = self.cache_dir / f"{key}.txt"
+        with self.lock:
+            try:
+                content = read_file(path)
+                os.utime(path)
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return content
+
+    def put(self, key: str, content: str):
+        path = self.cache_dir / f"{key}.txt"
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with self.lock:
+            previous = path.stat().st_size if path.exists() else 0
+            write_file(tmp_path, content)
+            os.replace(tmp_path, path)
+            self.total_bytes += path.stat().st_size - previous
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until we are back under 90% of the bound.
+        entries = sorted(self.cache_dir.glob("*.txt"), key=lambda f: f.stat().st_mtime)
+        for path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            self.total_bytes -= path.stat().st_size
+            path.unlink()
+
+    def clear(self):
+        with self.lock:
+            for path in self.cache_dir.glob("*.txt"):
+                path.unlink()
+            self.total_bytes = 0
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
+
+# ========================== TEST PACKING ==========================
+PACK_DELIMITER = "# ===== TEST {} ====="
+PACK_DELIMITER_RE = re.compile(r"^# ===== TEST (\d+) =====[ \t]*$", re.MULTILINE)
+
+def plan_packs(test_cases: list[str], pack_tokens: int) -> list[list[int]]:
+    # Greedily group consecutive test indices so that each pack stays within
+    # `pack_tokens` estimated tokens. A test larger than the budget forms its own pack.
+    packs, current, current_tokens = [], [], 0
+    for idx, test_case in enumerate(test_cases):
+        tokens = estimate_tokens(test_case)
+        if current and current_tokens + tokens > pack_tokens:
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append(idx)
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+def split_packed_output(output: str, expected: int) -> list[str] | None:
+    markers = list(PACK_DELIMITER_RE.finditer(output))
+    if [int(m.group(1)) for m in markers] != list(range(1, expected + 1)):
+        return None
+    if output[:markers[0].start()].strip():
+        return None  # prose or code before the first delimiter
+    parts = []
+    for m, nxt in zip(markers, markers[1:] + [None]):
+        part = output[m.end():nxt.start() if nxt else len(output)].strip()
+        if not part:
+            return None
+        parts.append(part)
+    return parts
+
+# ========================== STEP FUSION ==========================
+# A fusion plan such as "[1,2] [3] [4,5,6] [7]" merges consecutive steps into
+# one instruction, so a test takes one round trip per group instead of per step.
+FUSION_DELIMITER = "# ===== AFTER CHANGE {} ====="
+FUSION_DELIMITER_RE = re.compile(r"^# ===== AFTER CHANGE (\d+) =====[ \t]*$", re.MULTILINE)
+
+def fusion_plan_arg(value: str) -> list[list[int]]:
+    # argparse type for "--fusion '[1,2] [3] [4,5,6] [7]'".
+    groups = re.findall(r"\[([^\]]*)\]", value)
+    if not groups or re.sub(r"\[[^\]]*\]", "", value).strip():
+        raise argparse.ArgumentTypeError(f"expected groups like '[1,2] [3]', got {value!r}")
+    try:
+        return [[int(k) for k in group.split(",")] for group in groups]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"step numbers must be integers, got {value!r}")
+
+def check_fusion_plan(plan: list[list[int]], n_steps: int) -> str | None:
+    # Groups must be consecutive runs that cover every step exactly once, in order.
+    flat = [k for group in plan for k in group]
+    if flat != list(range(1, n_steps + 1)):
+        return f"fusion plan must list steps 1..{n_steps} once each, in order, got {flat}"
+    return None
+
+def fuse_step_prompts(prompts: list[str], intermediates: bool) -> str:
+    # One instruction applying several transformation paragraphs in sequence.
+    # With `intermediates`, the model also emits the test after every change.
+    numbered = " ".join(f"({k}) {prompt}" for k, prompt in enumerate(prompts, start=1))
+    fused = f"the {len(prompts)} changes below, each applied to the result of the previous one: {numbered}"
+    if intermediates:
+        fused = fused.rstrip(". ") + (f". Output the function after each of the {len(prompts)} changes, each version "
+                  f"directly below a line '{FUSION_DELIMITER.format('<k>')}' where <k> is the number of the change, in order")
+    return fused
+
+def fused_version_count(change_prompt: str) -> int:
+    # How many versions of the test the instruction asks for: one per change
+    # for fused prompts with intermediates, otherwise one.
+    match = re.search(r"Output the function after each of the (\d+) changes", change_prompt)
+    return int(match.group(1)) if match else 1
+
+def split_fused_output(output: str, expected: int) -> list[str] | None:
+    # The per-change versions of one fused output, or None if the delimiters are off.
+    markers = list(FUSION_DELIMITER_RE.finditer(output))
+    if [int(m.group(1)) for m in markers] != list(range(1, expected + 1)):
+        return None
+    parts = [output[m.end():nxt.start() if nxt else len(output)].strip()
+             for m, nxt in zip(markers, markers[1:] + [None])]
+    return parts if all(parts) else None
+
+def final_fused_version(output: str) -> str:
+    # The last version in a fused output, even when its delimiters are incomplete.
+    markers = list(FUSION_DELIMITER_RE.finditer(output))
+    return output[markers[-1].end():].strip() if markers else output
+
 # ========================== LLM AGENT CLASS ==========================
 class TestImprovementAgent:
     #LLM agent that keeps a static system prompt (with module context) and
         # sends a fresh user message each call. No conversation history is
         # accumulated, which avoids token bloat while still giving the model the
 
-    def __init__(self, api_key: str, module_prompt: str, model: str = "gpt-4o"):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key: str, module_prompt: str, model: str = "gpt-4o",
+                 rpm: int = 500, tpm: int = 30000, max_concurrency: int = 0,
+                 cache: ResponseCache | None = None, base_url: str | None = None,
+                 context_slicer: ContextSlicer | None = None, candidates: int = 1,
+                 candidate_mode: str = "n", hedging: HedgePolicy | None = None,
+                 retry: RetryPolicy | None = None, breaker: CircuitBreaker | None = None,
+                 http_client: DefaultHttpxClient | None = None, stream: bool = False,
+                 stream_retries: int = 2):
+        # base_url lets the agent talk to any OpenAI-compatible endpoint,
+        # e.g. a local stand-in server during tests.
+        # An empty api_key falls back to the OPENAI_API_KEY environment variable.
+        # Retries are handled by self.retry, so the SDK's own retries are off.
+        # An `http_client` (see shared_http_client) sets pool size, keep-alive
+        # and timeouts; without one the SDK builds its own default client.
+        self.client = OpenAI(api_key=api_key or None, base_url=base_url, max_retries=0,
+                             http_client=http_client)
+        self.http_timeout = http_client.timeout if http_client is not None else None
         self.base_messages = [
             {
                 "role": "system",
@@ -114,90 +1874,1120 @@ class TestImprovementAgent:
             }
         ]
         self.model = model
+        self.temperature = 0.2
+        self.cache = cache
+        self.rate_limiter = RateLimiter(rpm, tpm)
+        # max_concurrency > 0 turns on the adaptive window, capped at that value.
+        self.concurrency = AIMDController(max_concurrency) if max_concurrency > 0 else None
+        # With a slicer, module code travels per request (only what the test
+        # needs) instead of in full inside the system prompt.
+        self.context_slicer = context_slicer
+        # With candidates > 1, step requests ask for several completions (one
+        # request with n choices, or parallel requests) and keep the first one
+        # that passes the local checks.
+        self.candidates = candidates
+        self.candidate_mode = candidate_mode
+        # With a hedge policy, slow requests get a duplicate (see _hedged_request).
+        self.hedging = hedging
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        # Streaming mode: single-choice answers are validated while they arrive
+        # and restarted up to `stream_retries` times; the last attempt is kept.
+        self.stream = stream
+        self.stream_retries = stream_retries
+        self.stream_stats = StreamStats()
+        # Per-thread timing of the HTTP call in flight: `started` and, once it
+        # has finished, `latency`; `signal` is set when the call starts.
+        self.http_call = threading.local()
+        self.usage = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                      "cascaded": 0, "escalated": 0}
+        self.usage_lock = threading.Lock()
 
-    def improve_test(self, test_case: str, change_prompt: str, is_step: bool) -> str:
-        # Send ONE user message with the test + change instruction.
-        # No previous user/assistant messages are persisted.
+    def build_user_message(self, test_case: str, change_prompt: str, is_step: bool) -> str:
+        # Canonical layout for provider-side prefix caching: the system prompt
+        # (static module context) comes first, then the step instruction, which
+        # is identical for every test of a step, and only then the per-test
+        # parts (context slice, test code). Nothing test-specific may appear
+        # before the instruction, or the shared prefix ends there.
         if is_step:
-            user_msg = (
-                f"Here is a pytest test case:\n{test_case}\n"
-                f"Please understand the logic and semantic. Then, improve the readability of the function while strictly preserving semantics and grammar correctness by the following changes : {change_prompt}. \n"
-                f"Output only the modified function. Return modified python code only without markdown formatting (no ```python ... ```), and Do not add any import statements. "
+            context = self.context_slicer.context_for(test_case) if self.context_slicer else ""
+            return (
+                f"Please understand the logic and semantic of the pytest test case below. Then, improve the readability of the function while strictly preserving semantics and grammar correctness by the following changes : {change_prompt}. \n"
+                f"Output only the modified function. Return modified python code only without markdown formatting (no ```python ... ```), and Do not add any import statements. \n\n"
                 # f"we sequentially apply the enhancement rules. Each rule is checked for applicability—if a match is found, the corresponding transformation is applied; otherwise, the rule is skipped without modification.:\n{change_prompt}\n"
+                f"{context}"
+                f"Here is the pytest test case:\n{test_case}\n"
             )
-        else:
-            user_msg = (
-                f"Please check and correct only grammatical or syntax errors in the following Python module. "
-                f"Do not change code structure or logic. Only add necessary missing import statements. "
-                f"Output the corrected code only, without explanations or markdown formatting (no ```python ... ```).\n{test_case}\n"
-            )
+        return (
+            f"Please check and correct only grammatical or syntax errors in the following Python module. "
+            f"Do not change code structure or logic. Only add necessary missing import statements. "
+            f"Output the corrected code only, without explanations or markdown formatting (no ```python ... ```).\n{test_case}\n"
+        )
+
+    def record_usage(self, prompt_tokens: int, cached_tokens: int, completion_tokens: int):
+        with self.usage_lock:
+            self.usage["calls"] += 1
+            self.usage["prompt_tokens"] += prompt_tokens
+            self.usage["cached_tokens"] += cached_tokens
+            self.usage["completion_tokens"] += completion_tokens
+
+    def usage_report(self, since: dict | None = None) -> str:
+        # Token usage (optionally relative to an earlier snapshot of self.usage),
+        # including how much of the prompt the provider served from its prefix cache.
+        with self.usage_lock:
+            usage = {k: v - (since or {}).get(k, 0) for k, v in self.usage.items()}
+        share = usage["cached_tokens"] / usage["prompt_tokens"] if usage["prompt_tokens"] else 0.0
+        report = (f"{usage['calls']} calls, {usage['prompt_tokens']} prompt tokens "
+                  f"({usage['cached_tokens']} cached, {share:.0%}), {usage['completion_tokens']} completion tokens")
+        if usage["cascaded"]:
+            report += (f", {usage['escalated']}/{usage['cascaded']} cascaded tests escalated "
+                       f"({usage['escalated'] / usage['cascaded']:.0%})")
+        return report
+
+    def cache_key(self, user_msg: str, model: str | None = None) -> str:
+        return ResponseCache.make_key(model or self.model, self.temperature, self.base_messages[0]["content"], user_msg)
+
+    def improve_test(self, test_case: str, change_prompt: str, is_step: bool,
+                     cheap_model: str | None = None) -> str:
+        # When every attempt fails, the input comes back unchanged: a failed call
+        # must never drop a test (or the whole file, for fix passes) from the output.
+        output = self._improve_test(test_case, change_prompt, is_step, cheap_model)
+        if not output:
+            print("No usable answer after retries, keeping the input unchanged")
+            return test_case
+        return output
 
+    def _improve_test(self, test_case: str, change_prompt: str, is_step: bool,
+                      cheap_model: str | None = None) -> str:
+        # Send ONE user message with the test + change instruction.
+        # No previous user/assistant messages are persisted.
+        # With a `cheap_model`, the step is tried there first and escalated to
+        # self.model only when the answer fails the local checks.
+        user_msg = self.build_user_message(test_case, change_prompt, is_step)
+        if not is_step:
+            return self.complete(user_msg, estimate_tokens(test_case))
+        expected_tokens = estimate_tokens(test_case) * fused_version_count(change_prompt)
+
+        def accept(output: str) -> bool:
+            return passes_local_checks(test_case, final_fused_version(output), change_prompt)
+
+        if cheap_model and cheap_model != self.model:
+            output = self.complete(user_msg, expected_tokens, accept=accept, model=cheap_model)
+            escalate = not accept(output)
+            with self.usage_lock:
+                self.usage["cascaded"] += 1
+                self.usage["escalated"] += escalate
+            if not escalate:
+                return output
+        return self.complete(user_msg, expected_tokens, accept=accept)
+
+    def improve_test_edits(self, test_case: str, change_prompt: str) -> str:
+        # Edit-operation mode: the model returns a compact JSON edit list that
+        # is applied locally to the original test, which costs a few dozen
+        # completion tokens instead of the whole function. Falls back to a
+        # regular full rewrite when the edit cannot be parsed or applied.
+        context = self.context_slicer.context_for(test_case) if self.context_slicer else ""
+        user_msg = (
+            f"Please understand the logic and semantic of the pytest test case below. Then, improve the readability of the function while strictly preserving semantics and grammar correctness by the following changes : {change_prompt}. \n"
+            f"Do not output the modified function. {EDIT_FORMAT}\n\n"
+            f"{context}"
+            f"Here is the pytest test case with numbered lines:\n{number_lines(test_case)}\n"
+        )
+        ops = parse_edit_ops(self.complete(user_msg, 100))
+        edited = apply_edit_ops(test_case, ops) if ops is not None else None
+        if edited is not None:
+            return edited
+        print("Edit list could not be applied, falling back to a full rewrite")
+        return self.improve_test(test_case, change_prompt, True)
+
+    def improve_tests_packed(self, test_cases: list[str], change_prompt: str) -> list[str] | None:
+        # Transform several tests with one request. Every test is introduced by
+        # a numbered delimiter line that the model must echo back; the answer is
+        # split on those lines and only accepted when exactly the same numbers
+        # come back in order. Returns None when the output does not split cleanly.
+        packed = "\n\n".join(f"{PACK_DELIMITER.format(k)}\n{tc}" for k, tc in enumerate(test_cases, start=1))
+        context = self.context_slicer.context_for("\n".join(test_cases)) if self.context_slicer else ""
+        user_msg = (
+            f"Please understand the logic and semantic of the pytest test cases below. Then, improve the readability of each function independently while strictly preserving semantics and grammar correctness by the following changes : {change_prompt}. \n"
+            f"Every test is introduced by a delimiter line of the form '{PACK_DELIMITER.format('<k>')}'. "
+            f"Output every modified function directly below its own unchanged delimiter line, keeping all delimiters in the original order. "
+            f"Return python code only without markdown formatting (no ```python ... ```), and Do not add any import statements. \n\n"
+            f"{context}"
+            f"Here are the {len(test_cases)} pytest test cases:\n{packed}\n"
+        )
+        output = self.complete(user_msg, sum(estimate_tokens(tc) for tc in test_cases) * fused_version_count(change_prompt))
+        return split_packed_output(output, len(test_cases))
+
+    def complete(self, user_msg: str, expected_completion_tokens: int, accept=None,
+                 model: str | None = None) -> str:
+        # `accept(output) -> bool` enables speculative candidates: with
+        # self.candidates > 1 the first accepted output wins, and the first
+        # output is kept when none is accepted. `model` overrides self.model.
+        model = model or self.model
         messages = self.base_messages + [{"role": "user", "content": user_msg}]
 
         # print("OpenAI message: \n", messages[:500], "...\n")
 
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache_key(user_msg, model)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
         try:
-            resp = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.2,
-                n=1,
-            )
-            return resp.choices[0].message.content.strip()
+            if accept is None or self.candidates <= 1:
+                content = self._hedged_request(model, messages, expected_completion_tokens, 1)[0]
+            elif self.candidate_mode == "n":
+                outputs = self._hedged_request(model, messages, expected_completion_tokens, self.candidates)
+                content = self._first_accepted(outputs, accept)
+            else:
+                content = self._race(model, messages, expected_completion_tokens, accept)
+            if cache_key is not None and content:
+                self.cache.put(cache_key, content)
+            return content
         except Exception as e:
             print(f"OpenAI call failed: {e}")
             return ""
 
+    def _request(self, model: str, messages: list[dict], expected_completion_tokens: int, n: int,
+                 stream: bool = False) -> list[str]:
+        # One rate-limited chat completion with n choices; returns their contents.
+        # `stream` streams a single choice even without self.stream.
+        if (self.stream or stream) and n == 1:
+            for attempt in range(self.stream_retries + 1):
+                output, problem = self._stream(model, messages, expected_completion_tokens,
+                                               validate=self.stream and attempt < self.stream_retries)
+                if problem is None or problem == STREAM_CANCELLED:
+                    return [output]
+                print(f"Aborted streamed answer after ~{estimate_tokens(output)} tokens ({problem}), retrying")
+        # Reserve prompt tokens plus the expected size of the rewritten code.
+        estimated_tokens = estimate_message_tokens(messages) + n * expected_completion_tokens
+        self.rate_limiter.acquire(estimated_tokens)
+        raw = self._create_with_retries(
+            estimated_tokens,
+            model=model,
+            messages=messages,
+            temperature=self.temperature,
+            n=n,
+        )
+        self.rate_limiter.update_from_headers(raw.headers)
+        resp = raw.parse()
+        self.rate_limiter.settle(estimated_tokens, resp.usage.total_tokens if resp.usage else None)
+        if resp.usage:
+            details = getattr(resp.usage, "prompt_tokens_details", None)
+            self.record_usage(resp.usage.prompt_tokens, getattr(details, "cached_tokens", 0) or 0,
+                              resp.usage.completion_tokens)
+        return [(choice.message.content or "").strip() for choice in resp.choices] or [""]
+
+    def _stream(self, model: str, messages: list[dict], expected_completion_tokens: int,
+                validate: bool) -> tuple[str, str | None]:
+        # Stream one answer. With `validate`, stop reading as soon as
+        # stream_problem() objects and return (partial text, problem). Once the
+        # thread's http_call.cancel event is set (see _race), the stream is
+        # closed and (partial text, STREAM_CANCELLED) returned.
+        cancel = getattr(self.http_call, "cancel", None)
+        if cancel is not None and cancel.is_set():
+            return "", STREAM_CANCELLED
+        estimated_tokens = estimate_message_tokens(messages) + expected_completion_tokens
+        self.rate_limiter.acquire(estimated_tokens)
+        start = time.monotonic()
+        raw = self._create_with_retries(
+            estimated_tokens,
+            model=model,
+            messages=messages,
+            temperature=self.temperature,
+            n=1,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        self.rate_limiter.update_from_headers(raw.headers)
+        text, usage, problem, first_token, error = "", None, None, None, None
+        try:
+            stream = raw.parse()
+        except Exception as e:
+            self._release_stream(e)
+            raise
+        try:
+            for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if first_token is None:
+                    first_token = time.monotonic()
+                text += chunk.choices[0].delta.content
+                if validate and (problem := stream_problem(text, expected_completion_tokens)):
+                    break
+                if cancel is not None and cancel.is_set():
+                    problem = STREAM_CANCELLED
+                    break
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            stream.close()
+            self._release_stream(error)
+        end = time.monotonic()
+
+        # Aborted streams never send their usage chunk; count estimates instead.
+        self.rate_limiter.settle(estimated_tokens, usage.total_tokens if usage else None)
+        if usage:
+            details = getattr(usage, "prompt_tokens_details", None)
+            self.record_usage(usage.prompt_tokens, getattr(details, "cached_tokens", 0) or 0, usage.completion_tokens)
+        else:
+            self.record_usage(estimate_message_tokens(messages), 0, estimate_tokens(text))
+        completion_tokens = usage.completion_tokens if usage else estimate_tokens(text)
+        rate = completion_tokens / (end - first_token) if first_token is not None and end > first_token else None
+        self.stream_stats.record(first_token - start if first_token is not None else None, rate, problem not in (None, STREAM_CANCELLED))
+        return text.strip(), problem
+
+    def _hedged_request(self, model: str, messages: list[dict], expected_completion_tokens: int,
+                        n: int) -> list[str]:
+        # _request, plus one duplicate when the first attempt's HTTP call
+        # outlives the hedge threshold; whichever attempt succeeds first wins.
+        # Only the HTTP call is timed, not the wait for the rate limiter,
+        # breaker, AIMD window or retry backoff. The loser is left to finish in
+        # the background, since in-flight calls cannot be aborted.
+        if self.hedging is None:
+            return self._request(model, messages, expected_completion_tokens, n)
+
+        def timed(started: threading.Event) -> list[str]:
+            self.http_call.signal = started
+            try:
+                outputs = self._request(model, messages, expected_completion_tokens, n)
+            finally:
+                self.http_call.signal = None
+                started.set()
+            if self.http_call.latency is not None:
+                self.hedging.record(self.http_call.latency)
+            return outputs
+
+        pool = ThreadPoolExecutor(max_workers=2)
+        try:
+            started = threading.Event()
+            primary = pool.submit(timed, started)
+            threshold = self.hedging.threshold()
+            started.wait()  # the hedge timer starts with the HTTP call
+            done, _ = wait([primary], timeout=threshold)
+            if done or not self.hedging.try_hedge():
+                return primary.result()
+            backup = pool.submit(timed, threading.Event())
+            error = None
+            for future in as_completed([primary, backup]):
+                try:
+                    outputs = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is backup:
+                    self.hedging.backup_won()
+                return outputs
+            raise error
+        finally:
+            pool.shutdown(wait=False)
+
+    @staticmethod
+    def _first_accepted(outputs: list[str], accept) -> str:
+        for k, output in enumerate(outputs, start=1):
+            if accept(output):
+                if k > 1:
+                    print(f"Candidate 1 failed local checks, using candidate {k}/{len(outputs)}")
+                return output
+        print(f"None of {len(outputs)} candidates passed local checks, keeping the first")
+        return outputs[0]
+
+    def _race(self, model: str, messages: list[dict], expected_completion_tokens: int, accept) -> str:
+        # Fire self.candidates single-choice requests in parallel and return the
+        # first accepted answer. The requests are streamed, so once an answer is
+        # accepted the others close their streams at the next chunk, which stops
+        # their generation and frees their AIMD slots.
+        done = threading.Event()
+
+        def candidate() -> list[str]:
+            self.http_call.cancel = done
+            try:
+                return self._request(model, messages, expected_completion_tokens, 1, stream=True)
+            finally:
+                self.http_call.cancel = None
+
+        pool = ThreadPoolExecutor(max_workers=self.candidates)
+        futures = [pool.submit(candidate) for _ in range(self.candidates)]
+        outputs, errors = [], []
+        try:
+            for future in as_completed(futures):
+                try:
+                    output = future.result()[0]
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if accept(output):
+                    return output
+                outputs.append(output)
+        finally:
+            done.set()
+            pool.shutdown(wait=False)
+        if not outputs:
+            raise errors[0]
+        print(f"None of {len(outputs)} candidates passed local checks, keeping the first")
+        return outputs[0]
+
+    def improve_tests_batch(self, test_cases: list[str], change_prompt: str, custom_ids: list[str],
+                            batch_file: Path, poll_interval: float = 30.0) -> list[str]:
+        # Offline alternative to calling improve_test per test: write every
+        # request into a Batch API JSONL file, submit it, poll until the batch
+        # reaches a terminal state and map the results back by custom_id.
+        # Cached requests are not resubmitted; requests the batch did not
+        # answer fall back to a regular synchronous call.
+        results = {}
+        user_msgs = {}
+        lines = []
+        for custom_id, test_case in zip(custom_ids, test_cases):
+            user_msg = self.build_user_message(test_case, change_prompt, True)
+            user_msgs[custom_id] = user_msg
+            if self.cache is not None:
+                cached = self.cache.get(self.cache_key(user_msg))
+                if cached is not None:
+                    results[custom_id] = cached
+                    continue
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": self.base_messages + [{"role": "user", "content": user_msg}],
+                    "temperature": self.temperature,
+                    "n": 1,
+                },
+            }, ensure_ascii=False))
+
+        if lines:
+            write_file(batch_file, "\n".join(lines) + "\n")
+            with batch_file.open("rb") as f:
+                uploaded = self.client.files.create(file=f, purpose="batch")
+            batch = self.client.batches.create(input_file_id=uploaded.id,
+                                               endpoint="/v1/chat/completions",
+                                               completion_window="24h")
+            print(f"Submitted batch {batch.id} with {len(lines)} requests")
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                time.sleep(poll_interval)
+                batch = self.client.batches.retrieve(batch.id)
+                counts = batch.request_counts
+                done = f"{counts.completed}/{counts.total}" if counts else "?"
+                print(f"Batch {batch.id}: {batch.status} ({done} done)")
+
+            # Expired batches still deliver the requests that finished in time.
+            if batch.output_file_id:
+                output = self.client.files.content(batch.output_file_id).text
+                for line in output.splitlines():
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    response = record.get("response") or {}
+                    if response.get("status_code") != 200:
+                        continue
+                    body = response["body"]
+                    usage = body.get("usage") or {}
+                    self.record_usage(usage.get("prompt_tokens", 0),
+                                      (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+                                      usage.get("completion_tokens", 0))
+                    content = body["choices"][0]["message"]["content"].strip()
+                    results[record["custom_id"]] = content
+                    if self.cache is not None and content:
+                        self.cache.put(self.cache_key(user_msgs[record["custom_id"]]), content)
+
+        improved = []
+        for custom_id, test_case in zip(custom_ids, test_cases):
+            if custom_id not in results:
+                print(f"Batch gave no result for {custom_id}, calling synchronously")
+                results[custom_id] = self.improve_test(test_case, change_prompt, True)
+            improved.append(results[custom_id])
+        return improved
+
+    def _create_with_retries(self, estimated_tokens: int, **request):
+        # _create under the retry policy and circuit breaker. Non-retryable
+        # errors, the last retry and a spent deadline re-raise to the caller.
+        # The caller has reserved `estimated_tokens` for the first attempt;
+        # every retry reserves them again, and the rate-limit headers of failed
+        # responses (429s in particular) update the limiter, so retries under
+        # pressure are paced like new calls.
+        deadline = time.monotonic() + self.retry.deadline
+        attempt = 0
+        while True:
+            self.breaker.wait()
+            if attempt:
+                self.rate_limiter.acquire(estimated_tokens)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"per-call deadline of {self.retry.deadline:.0f}s exceeded")
+            # The deadline caps the read timeout; other phases keep the client's limits.
+            timeout = remaining
+            if self.http_timeout is not None:
+                timeout = http_lib.Timeout(connect=self.http_timeout.connect, write=self.http_timeout.write,
+                                        pool=self.http_timeout.pool,
+                                        read=min(self.http_timeout.read or remaining, remaining))
+            try:
+                raw = self._create(timeout=timeout, **request)
+            except Exception as e:
+                self.breaker.record(False)
+                if isinstance(e, APIStatusError):
+                    self.rate_limiter.update_from_headers(e.response.headers)
+                if not is_retryable_error(e) or attempt >= self.retry.max_retries:
+                    raise
+                pause = self.retry.delay(attempt, e)
+                if time.monotonic() + pause >= deadline:
+                    raise
+                attempt += 1
+                print(f"Retrying in {pause:.1f}s (attempt {attempt + 1}/{self.retry.max_retries + 1}): {e}")
+                time.sleep(pause)
+                continue
+            self.breaker.record(True)
+            return raw
+
+    def _create(self, **request):
+        # Issue the raw chat completion, gated and measured by the AIMD window.
+        # A streamed response keeps its slot until _stream has consumed or
+        # closed it (see _release_stream), so the window bounds generations.
+        if self.concurrency is not None:
+            self.concurrency.acquire()
+        start = self._start_http_call()
+        try:
+            raw = self.client.chat.completions.with_raw_response.create(**request)
+        except Exception as e:
+            if self.concurrency is not None:
+                self.concurrency.release(None, overloaded=is_overload_error(e))
+            raise
+        if request.get("stream"):
+            return raw
+        self.http_call.latency = time.monotonic() - start
+        if self.concurrency is not None:
+            self.concurrency.release(self.http_call.latency)
+        return raw
+
+    def _start_http_call(self) -> float:
+        # Mark the start of an HTTP call on this thread, waking a hedge timer
+        # waiting for it (see _hedged_request).
+        self.http_call.started = time.monotonic()
+        self.http_call.latency = None
+        signal = getattr(self.http_call, "signal", None)
+        if signal is not None:
+            signal.set()
+        return self.http_call.started
+
+    def _release_stream(self, error: Exception | None = None):
+        # End this thread's streamed HTTP call and give back its AIMD slot.
+        if error is None:
+            self.http_call.latency = time.monotonic() - self.http_call.started
+        if self.concurrency is None:
+            return
+        if error is None:
+            self.concurrency.release(self.http_call.latency)
+        else:
+            self.concurrency.release(None, overloaded=is_overload_error(error))
+
+# ========================== CHECKPOINTING ==========================
+class RunJournal:
+    # Append-only JSONL journal of finished work. Every completed call writes
+    #   {"step": k, "index": i, "input": <hash of prompt + test>, "output": "..."}
+    # and every written _improvedk.py adds {"step": k, "done": true}. Records are
+    # flushed as they finish, so a crash loses at most the calls still in flight.
+    # The input hash guards against reusing outputs after the test or the
+    # transformation prompt changed.
+
+    def __init__(self, path: Path, resume: bool):
+        self.path = path
+        self.outputs = {}
+        self.done_steps = set()
+        if resume and path.exists():
+            for line in read_file(path).splitlines():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn last line from a crash
+                if record.get("done"):
+                    self.done_steps.add(record["step"])
+                else:
+                    self.outputs[(record["step"], record["index"], record["input"])] = record["output"]
+        self.lock = threading.Lock()
+        self.file = path.open("a" if resume else "w", encoding="utf-8")
+
+    @staticmethod
+    def _input_hash(change_prompt: str, test_case: str) -> str:
+        return hashlib.sha256(f"{change_prompt}\0{test_case}".encode("utf-8")).hexdigest()
+
+    def _append(self, record: dict):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def lookup(self, step: int, index: int, change_prompt: str, test_case: str) -> str | None:
+        return self.outputs.get((step, index, self._input_hash(change_prompt, test_case)))
+
+    def record(self, step: int, index: int, change_prompt: str, test_case: str, output: str):
+        input_hash = self._input_hash(change_prompt, test_case)
+        self.outputs[(step, index, input_hash)] = output
+        self._append({"step": step, "index": index, "input": input_hash, "output": output})
+
+    def mark_step_done(self, step: int):
+        self.done_steps.add(step)
+        self._append({"step": step, "done": True})
+
+    def last_finished_step(self, output_dir: Path, stem: str) -> int:
+        # The newest step that is both journaled as done and still on disk.
+        finished = [k for k in self.done_steps if (output_dir / f"{stem}_improved{k}.py").exists()]
+        return max(finished, default=0)
+
+    def close(self):
+        self.file.close()
+
+# ========================== STEP EXECUTION ==========================
+def cascade_arg(value: str) -> tuple[int, str]:
+    # argparse type for "--cascade 4=gpt-4o-mini": step number and cheap model.
+    step, _, model = value.partition("=")
+    if not step.isdigit() or not model:
+        raise argparse.ArgumentTypeError(f"expected <step>=<model>, got {value!r}")
+    return int(step), model
+
+def run_step(agent: TestImprovementAgent, test_cases: list[str], change_prompt: str,
+             step_idx: int, max_in_flight: int = 1, journal: RunJournal | None = None,
+             batch_dir: Path | None = None, poll_interval: float = 30.0,
+             pack_tokens: int = 0, edit_mode: bool = False, engine: str = "llm",
+             prefilter: bool = False, dedup: bool = False, cheap_model: str | None = None) -> list[str]:
+    # Dispatch one transformation step over all test cases with at most
+    # `max_in_flight` concurrent LLM requests. Results are returned in the
+    # original test order, so the merged file is identical to a sequential run.
+    # Tests already recorded in the journal are not sent again. With a
+    # `batch_dir`, the remaining tests go through the Batch API instead.
+    # With `pack_tokens` > 0, consecutive tests are packed into shared requests
+    # of at most that many estimated tokens. With `edit_mode`, single-test calls
+    # ask for an edit list instead of the rewritten function. An `engine` other
+    # than "llm" first runs the step's local transformation, if it has one.
+    # With `prefilter`, tests the step provably cannot change are passed through.
+    # With `dedup`, structurally identical tests share one request. With a
+    # `cheap_model`, single-test calls try that model before the default one.
+    total = len(test_cases)
+    if engine != "llm":
+        local = [local_transform(tc, change_prompt, engine) for tc in test_cases]
+        test_cases = [tc for tc, _ in local]
+        if local and all(done for _, done in local):
+            print(f"[Step {step_idx}] Transformed {total} tests locally")
+            return test_cases
+    improved_tests = [None] * total
+    if prefilter:
+        for i, test_case in enumerate(test_cases):
+            if not step_applies(test_case, change_prompt):
+                improved_tests[i] = test_case
+        skipped = sum(t is not None for t in improved_tests)
+        print(f"[Step {step_idx}] Prefilter: {skipped}/{total} tests skipped "
+              f"({skipped / total if total else 0:.0%}), step cannot apply")
+
+    if journal is not None:
+        for i, test_case in enumerate(test_cases, start=1):
+            if improved_tests[i - 1] is None:
+                improved_tests[i - 1] = journal.lookup(step_idx, i, change_prompt, test_case)
+        restored = sum(t is not None for t in improved_tests) - (skipped if prefilter else 0)
+        if restored:
+            print(f"[Step {step_idx}] {restored}/{total} tests restored from journal")
+    pending = [(i, tc) for i, tc in enumerate(test_cases, start=1) if improved_tests[i - 1] is None]
+
+    def finish(i: int, test_case: str, improved: str):
+        improved_tests[i - 1] = improved
+        # Tests kept unchanged (e.g. after failed calls) are retried on resume.
+        if journal is not None and improved and improved != test_case:
+            journal.record(step_idx, i, change_prompt, test_case, improved)
+
+    def process(indexed_test: tuple[int, str]):
+        i, test_case = indexed_test
+        print(f"[Step {step_idx}] Processing test {i}/{total}...")
+        if edit_mode:
+            finish(i, test_case, agent.improve_test_edits(test_case, change_prompt))
+        else:
+            finish(i, test_case, agent.improve_test(test_case, change_prompt, True, cheap_model))
+
+    def process_pack(pack: list[tuple[int, str]]):
+        if len(pack) > 1:
+            print(f"[Step {step_idx}] Processing tests {pack[0][0]}-{pack[-1][0]}/{total} as one pack...")
+            outputs = agent.improve_tests_packed([tc for _, tc in pack], change_prompt)
+            if outputs is not None:
+                for (i, test_case), improved in zip(pack, outputs):
+                    finish(i, test_case, improved)
+                return
+            print(f"[Step {step_idx}] Pack {pack[0][0]}-{pack[-1][0]} did not split cleanly, retrying one by one")
+        for item in pack:
+            process(item)
+
+    def dispatch(items: list[tuple[int, str]], round_name: str = ""):
+        if batch_dir is not None:
+            if items:
+                outputs = agent.improve_tests_batch([tc for _, tc in items], change_prompt,
+                                                    [f"step{step_idx}-test{i}" for i, _ in items],
+                                                    batch_dir / f"step{step_idx}{round_name}.batch.jsonl",
+                                                    poll_interval)
+                for (i, test_case), improved in zip(items, outputs):
+                    finish(i, test_case, improved)
+            return
+        if pack_tokens > 0:
+            work = [[items[k] for k in pack] for pack in plan_packs([tc for _, tc in items], pack_tokens)]
+        else:
+            work = [[item] for item in items]
+
+        if max_in_flight <= 1:
+            for pack in work:
+                process_pack(pack)
+        else:
+            # Each worker writes into its own slots, so completion order does not matter.
+            with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+                list(pool.map(process_pack, work))
+
+    if not dedup:
+        dispatch(pending)
+        return improved_tests
+
+    # Send one representative per structural cluster, replay its rewrite onto
+    # the other members and send only the members whose replay fails.
+    clusters = cluster_tests(pending)
+    dispatch([(i, tc) for (i, tc, _), *_ in clusters])
+    leftovers, replayed = [], 0
+    for (rep_i, _, rep_shape), *members in clusters:
+        rep_output = improved_tests[rep_i - 1]
+        for i, test_case, shape in members:
+            improved = replay_rewrite(rep_shape, rep_output, shape) if rep_output else None
+            if improved is None:
+                leftovers.append((i, test_case))
+            else:
+                finish(i, test_case, improved)
+                replayed += 1
+    print(f"[Step {step_idx}] Dedup: {len(pending)} tests in {len(clusters)} clusters, "
+          f"{replayed} replayed locally, {len(leftovers)} sent individually")
+    dispatch(leftovers, "-leftovers")
+    return improved_tests
+
+def repair_test(agent: TestImprovementAgent, test: str, resolver: ImportResolver,
+                step_idx: int, i: int) -> tuple[str, set[str], bool]:
+    # Compile one rewritten test and collect the imports it is missing; only a
+    # test that still fails goes back to the LLM. Returns (test, imports, sent).
+    test = strip_markdown_fences(test)
+    imports, ok = check_test_function(test, resolver)
+    if ok or not test:
+        return test, imports, False
+
+    print(f"[Step {step_idx}] Test {i} failed local checks, asking the LLM to fix it")
+    fixed = strip_markdown_fences(agent.improve_test(test, "", False))
+    extra_imports = set()
+    try:
+        # The fix may prepend imports; keep them for the import block.
+        fixed_imports, units = parse_test_module(fixed)
+        if units:
+            extra_imports = {line for line in fixed_imports.splitlines()
+                             if line.startswith(("import ", "from "))}
+            fixed = "\n\n".join(u.source for u in units)
+    except SyntaxError:
+        pass
+    test = fixed or test
+    imports, _ = check_test_function(test, resolver)
+    return test, imports | extra_imports, True
+
+def extend_import_block(import_block: str, imports: set[str]) -> str:
+    # Insert the new imports after the preamble's last import statement, since
+    # fixtures, helpers and constants may follow the imports.
+    new_imports = sorted(imports - set(import_block.splitlines()))
+    if not new_imports:
+        return import_block
+    lines = import_block.splitlines()
+    try:
+        body = ast.parse(import_block).body
+    except SyntaxError:
+        return "\n".join(lines + new_imports)
+    import_ends = [node.end_lineno for node in body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    docstring = docstring_node(ast.Module(body=body, type_ignores=[]))
+    at = max(import_ends, default=docstring.end_lineno if docstring is not None else 0)
+    return "\n".join(lines[:at] + new_imports + lines[at:])
+
+def repair_tests(agent: TestImprovementAgent, improved_tests: list[str], import_block: str,
+                 resolver: ImportResolver, step_idx: int) -> tuple[list[str], str]:
+    # Local replacement for the whole-file grammar-fix pass: every rewritten test
+    # is compiled on its own and missing imports are added from the resolver.
+    # Only the tests that still fail go back to the LLM, one at a time, so the
+    # fix cost scales with the number of broken tests instead of the file size.
+    repaired, missing_imports, sent = [], set(), 0
+    for i, test in enumerate(improved_tests, start=1):
+        test, imports, was_sent = repair_test(agent, test, resolver, step_idx, i)
+        repaired.append(test)
+        missing_imports |= imports
+        sent += was_sent
+
+    extended = extend_import_block(import_block, missing_imports)
+    if extended != import_block:
+        print(f"[Step {step_idx}] Added imports: {', '.join(sorted(missing_imports - set(import_block.splitlines())))}")
+    print(f"[Step {step_idx}] Local repair: {sent}/{len(improved_tests)} tests needed an LLM fix")
+    return repaired, extended
+
+def run_pipelined(agent: TestImprovementAgent, test_cases: list[str], steps: list[tuple[int, str]],
+                  import_block: str, resolver: ImportResolver, max_in_flight: int,
+                  journal: RunJournal | None, write_step, edit_steps: set[int] = frozenset(),
+                  step_engines: dict[int, str] | None = None, prefilter_steps: set[int] = frozenset(),
+                  cascade: dict[int, str] | None = None):
+    # Per-test chain mode: every test runs through all steps on its own, with
+    # local repair after each step, so a slow call only delays its own chain.
+    # At most `max_in_flight` chains (and therefore requests) run at once. A
+    # step's file is assembled and handed to write_step(step_idx, file) as
+    # soon as the last chain has passed that step; since every chain visits
+    # the steps in order, the files are still written in step order.
+    total = len(test_cases)
+    step_engines = step_engines or {}
+    cascade = cascade or {}
+    results = {step_idx: [None] * total for step_idx, _ in steps}
+    step_imports = {step_idx: set() for step_idx, _ in steps}
+    remaining = {step_idx: total for step_idx, _ in steps}
+    skipped = {step_idx: 0 for step_idx, _ in steps}
+    lock = threading.Lock()
+
+    def chain(indexed_test: tuple[int, str]):
+        i, test = indexed_test
+        for step_idx, change_prompt in steps:
+            test, local_only = local_transform(test, change_prompt, step_engines.get(step_idx, "llm"))
+            improved = test if local_only else None
+            if improved is None and step_idx in prefilter_steps and not step_applies(test, change_prompt):
+                improved = test
+                with lock:
+                    skipped[step_idx] += 1
+            if improved is None and journal is not None:
+                improved = journal.lookup(step_idx, i, change_prompt, test)
+            if improved is None:
+                print(f"[Step {step_idx}] Processing test {i}/{total}...")
+                if step_idx in edit_steps:
+                    improved = agent.improve_test_edits(test, change_prompt)
+                else:
+                    improved = agent.improve_test(test, change_prompt, True, cascade.get(step_idx))
+                if journal is not None and improved and improved != test:
+                    journal.record(step_idx, i, change_prompt, test, improved)
+            improved, imports, _ = repair_test(agent, improved, resolver, step_idx, i)
+
+            with lock:
+                results[step_idx][i - 1] = improved
+                step_imports[step_idx] |= imports
+                remaining[step_idx] -= 1
+                step_finished = remaining[step_idx] == 0
+            if step_finished:
+                if step_idx in prefilter_steps:
+                    print(f"[Step {step_idx}] Prefilter: {skipped[step_idx]}/{total} tests skipped "
+                          f"({skipped[step_idx] / total:.0%}), step cannot apply")
+                cumulative = set().union(*[step_imports[k] for k, _ in steps if k <= step_idx])
+                step_import_block = extend_import_block(import_block, cumulative)
+                write_step(step_idx, add_imports_to_tests(step_import_block, "\n\n".join(results[step_idx])))
+            test = improved
+
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as pool:
+        list(pool.map(chain, enumerate(test_cases, start=1)))
+
 # ========================== MAIN PIPELINE ==========================
+def write_intermediate_steps(group: list[int], fused_outputs: list[str], import_block: str, write_step):
+    # Write _improvedN.py for the inner steps of a fused group from the per-change
+    # versions in the outputs. These files are not repaired; if any test lacks
+    # its versions, the inner steps get no file.
+    versions = [split_fused_output(output, len(group)) for output in fused_outputs]
+    missing = sum(v is None for v in versions)
+    if missing:
+        print(f"[Step {group[-1]}] {missing}/{len(versions)} tests did not delimit their versions, "
+              f"no files for steps {', '.join(map(str, group[:-1]))}")
+        return
+    for k, step_idx in enumerate(group[:-1]):
+        tests = [strip_markdown_fences(v[k]) for v in versions]
+        write_step(step_idx, add_imports_to_tests(import_block, "\n\n".join(tests)))
+
+def improve_test_file(agent: TestImprovementAgent, test_path: Path, import_block: str,
+                      test_cases: list[str], changes_lines: list[str], output_dir: Path,
+                      module_sources: dict[str, str], args: argparse.Namespace):
+    # Run every transformation step over one test file, writing
+    # <stem>_improvedN.py after each step (or after each fused group of steps).
+    journal = RunJournal(output_dir / f"{test_path.stem}.journal.jsonl", resume=args.resume)
+    start_after = journal.last_finished_step(output_dir, test_path.stem) if args.resume else 0
+    if start_after:
+        resumed_file = output_dir / f"{test_path.stem}_improved{start_after}.py"
+        import_block = merge_preamble(import_block, read_file(resumed_file))
+        test_cases = extract_test_cases(read_file(resumed_file))
+        print(f"↻ Resuming after step {start_after} from {resumed_file.name}")
+
+    batch_dir = None
+    if args.batch:
+        batch_dir = output_dir / f"{test_path.stem}_batches"
+        batch_dir.mkdir(exist_ok=True)
+
+    def write_step(step_idx: int, full_test_file: str):
+        output_path = output_dir / f"{test_path.stem}_improved{step_idx}.py"
+        write_file(output_path, full_test_file)
+        journal.mark_step_done(step_idx)
+        print(f"✓ Output file: {output_path.name}")
+
+    # Steps run in fusion groups, each named after its last step. A group of one
+    # is a plain step; only those use edit mode, local engines and the prefilter.
+    groups = args.fusion or [[k] for k in range(1, len(changes_lines) + 1)]
+    groups = [[k for k in group if k > start_after] for group in groups]
+    groups = [group for group in groups if group]
+    single = {group[0]: changes_lines[group[0] - 1] for group in groups if len(group) == 1}
+    edit_steps = {k for k, prompt in single.items() if args.edit_mode and classify_step(prompt) in EDIT_STEP_KINDS}
+    step_engines = {k: engine for k, engine in args.step_engine if k in single}
+    prefilter_steps = set(single) if args.prefilter else set()
+
+    def group_prompt(group: list[int], intermediates: bool) -> str:
+        if len(group) == 1:
+            return changes_lines[group[0] - 1]
+        return fuse_step_prompts([changes_lines[k - 1] for k in group], intermediates)
+
+    if args.pipeline:
+        steps = [(group[-1], group_prompt(group, False)) for group in groups]
+        run_pipelined(agent, test_cases, steps, import_block, ImportResolver(import_block, module_sources),
+                      args.max_in_flight, journal, write_step, edit_steps=edit_steps,
+                      step_engines=step_engines, prefilter_steps=prefilter_steps, cascade=dict(args.cascade))
+        journal.close()
+        return
+
+    for group in groups:
+        step_idx = group[-1]
+        intermediates = len(group) > 1 and args.fusion_intermediates
+        change_prompt = group_prompt(group, intermediates)
+        if len(group) > 1:
+            print(f"[Step {step_idx}] Fusing steps {', '.join(map(str, group))} into one request per test")
+        usage_before = dict(agent.usage)
+        improved_tests = run_step(agent, test_cases, change_prompt, step_idx, args.max_in_flight, journal,
+                                  batch_dir=batch_dir,
+                                  poll_interval=args.batch_poll_interval,
+                                  pack_tokens=args.pack_tokens,
+                                  edit_mode=step_idx in edit_steps,
+                                  engine=step_engines.get(step_idx, "llm"),
+                                  prefilter=step_idx in prefilter_steps,
+                                  dedup=args.dedup,
+                                  cheap_model=dict(args.cascade).get(step_idx))
+        if len(group) > 1:
+            if intermediates:
+                write_intermediate_steps(group, improved_tests, import_block, write_step)
+            improved_tests = [final_fused_version(t) for t in improved_tests]
+
+        if args.fix_mode == "llm":
+            merged = "\n\n".join(improved_tests)
+            full_test_file = add_imports_to_tests(import_block, merged)
+            full_test_file = agent.improve_test(full_test_file, "", False)
+        else:
+            improved_tests, import_block = repair_tests(agent, improved_tests, import_block,
+                                                        ImportResolver(import_block, module_sources), step_idx)
+            full_test_file = add_imports_to_tests(import_block, "\n\n".join(improved_tests))
+
+        write_step(step_idx, full_test_file)
+        print(f"[Step {step_idx}] Usage: {agent.usage_report(usage_before)}")
+        import_block = merge_preamble(import_block, full_test_file)
+        test_cases = extract_test_cases(full_test_file)
+
+    journal.close()
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--modules', nargs='+', required=True, help='List of module file paths')
-    parser.add_argument('--test', required=True, help='Path to the test file')
+    parser.add_argument('--test', required=True, help='Path to the test file, or a directory of test_*.py files')
     parser.add_argument('--changes_file', required=True, help='File where each line is a prompt change')
-    parser.add_argument('--semantics', required=True, help='Path to semantic prompt file')
+    parser.add_argument('--semantics', help='Path to semantic prompt file')
+    parser.add_argument('--auto_semantics', action='store_true',
+                        help='Generate control-flow, data-flow, role and type summaries of the modules by static analysis')
+    parser.add_argument('--semantics_cache_dir', default='.semantics_cache',
+                        help='Directory caching generated summaries by module content hash')
     parser.add_argument('--output_dir', default='improved_tests', help='Directory to save output')
+    parser.add_argument('--max_in_flight', type=int, default=1,
+                        help='Maximum number of concurrent LLM requests per step (1 = sequential)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Let an AIMD controller tune concurrency up to --max_in_flight')
+    parser.add_argument('--cache_dir', default='.llm_cache', help='Directory of the on-disk response cache')
+    parser.add_argument('--cache_max_mb', type=int, default=512, help='Size bound of the response cache in MB')
+    parser.add_argument('--no_cache', action='store_true', help='Bypass the response cache')
+    parser.add_argument('--clear_cache', action='store_true', help='Empty the response cache before running')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from its journal and last finished output file')
+    parser.add_argument('--batch', action='store_true',
+                        help='Submit each step through the OpenAI Batch API instead of per-test calls '
+                             '(cannot be combined with --pack_tokens, --edit_mode, --cascade or --candidates)')
+    parser.add_argument('--batch_poll_interval', type=float, default=30.0,
+                        help='Seconds between batch status polls')
+    parser.add_argument('--pack_tokens', type=int, default=0,
+                        help='Pack several tests into one request up to this many estimated tokens (0 = off)')
+    parser.add_argument('--fix_mode', choices=['local', 'llm'], default='local',
+                        help='Repair each step locally and send only failing tests to the LLM, '
+                             'or send the whole merged file (llm)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run every test through all steps as its own chain instead of step by step '
+                             '(always uses local repair; --batch and --pack_tokens do not apply)')
+    parser.add_argument('--minify', choices=MINIFY_MODES, default='none',
+                        help='Compact module sources in the system prompt: strip docstrings/comments/blank lines, '
+                             'keep one-line docstring summaries, or keep only the public API')
+    parser.add_argument('--slice_context', action='store_true',
+                        help='Send each test only the module definitions it references (transitively) '
+                             'instead of every module in the system prompt')
+    parser.add_argument('--edit_mode', action='store_true',
+                        help='For renaming and unused-assignment steps, ask for a JSON edit list and apply it locally '
+                             'instead of having the model re-emit the whole function')
+    parser.add_argument('--step_engine', type=step_engine_arg, nargs='*', default=[],
+                        help='Per-step engine as <step>=llm|local|local-then-llm, e.g. "6=local 1=local-then-llm"; '
+                             'local engines exist for literal extraction and unused-assignment removal')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='Skip the LLM call for tests a step cannot change (e.g. no repeated literals, '
+                             'no unused assignments) and report skip rates per step')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Send one test per group of tests that differ only in literals and local names, '
+                             'and replay its rewrite onto the rest (step-by-step mode only)')
+    parser.add_argument('--fusion', type=fusion_plan_arg, default=None,
+                        help='Fuse consecutive steps into one request per test, e.g. "[1,2] [3] [4,5,6] [7]"; '
+                             'each group writes the _improvedN.py of its last step')
+    parser.add_argument('--fusion_intermediates', action='store_true',
+                        help='Also ask fused requests for the version after every step, to write the '
+                             'inner _improvedN.py files (step-by-step mode only)')
+    parser.add_argument('--candidates', type=int, default=1,
+                        help='Request this many candidates per test and keep the first that parses and keeps '
+                             'the asserts and called APIs of the original (1 = off)')
+    parser.add_argument('--candidate_mode', choices=['n', 'parallel'], default='n',
+                        help='Get candidates as choices of one request (n) or from parallel streamed requests, '
+                             'for endpoints without n support; the losing streams are closed once one is accepted')
+    parser.add_argument('--model', default='gpt-4o', help='Model used for every request (the strong model of a cascade)')
+    parser.add_argument('--cascade', type=cascade_arg, nargs='*', default=[],
+                        help='Per-step cheap model as <step>=<model>, e.g. "4=gpt-4o-mini 5=gpt-4o-mini"; tests go '
+                             'to the cheap model first and to --model only when the answer fails the local checks '
+                             '(for a fused group, use its last step)')
+    parser.add_argument('--hedge_quantile', type=float, default=0.0,
+                        help='Send a duplicate of any request still running after this latency quantile of '
+                             'recent calls, e.g. 0.95, and keep the first answer (0 = off)')
+    parser.add_argument('--hedge_max_ratio', type=float, default=0.1,
+                        help='Upper bound on duplicated requests as a share of all requests')
+    parser.add_argument('--max_retries', type=int, default=4,
+                        help='Retries for rate-limit, timeout, connection and 5xx errors, with exponential '
+                             'backoff and jitter; other 4xx errors are not retried')
+    parser.add_argument('--call_deadline', type=float, default=300.0,
+                        help='Seconds one call may take across all its retries before the test is kept unchanged')
+    parser.add_argument('--breaker_cooldown', type=float, default=30.0,
+                        help='Seconds dispatch pauses once half of the recent calls failed')
+    parser.add_argument('--pool_size', type=int, default=0,
+                        help='Maximum pooled HTTP connections (0 = twice the request concurrency, at least 10)')
+    parser.add_argument('--keepalive_expiry', type=float, default=60.0,
+                        help='Seconds an idle pooled connection is kept open for reuse')
+    parser.add_argument('--http2', action='store_true',
+                        help='Multiplex requests over HTTP/2 connections (needs the h2 package)')
+    parser.add_argument('--connect_timeout', type=float, default=10.0, help='HTTP connect timeout in seconds')
+    parser.add_argument('--read_timeout', type=float, default=120.0, help='HTTP read timeout in seconds')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream answers and restart early on markdown fences, prose preambles or output '
+                             'over 3x the expected size; reports time to first token and tokens/s')
+    parser.add_argument('--base_url', default=None,
+                        help='OpenAI-compatible endpoint, e.g. a local stand-in server')
+    parser.add_argument('--rpm', type=int, default=500, help='Requests-per-minute budget of the API key until the server reports its limit')
+    parser.add_argument('--tpm', type=int, default=30000, help='Tokens-per-minute budget of the API key until the server reports its limit')
     args = parser.parse_args()
+    if not args.semantics and not args.auto_semantics:
+        parser.error("one of --semantics or --auto_semantics is required")
+    changes_lines = load_prompt_lines(Path(args.changes_file))
+    if args.fusion and (problem := check_fusion_plan(args.fusion, len(changes_lines))):
+        parser.error(problem)
+    if args.batch:
+        # Batch requests are plain single-test calls; these options would be dropped silently.
+        unsupported = [flag for flag, used in (("--pack_tokens", args.pack_tokens > 0),
+                                               ("--edit_mode", args.edit_mode),
+                                               ("--cascade", bool(args.cascade)),
+                                               ("--candidates", args.candidates > 1)) if used]
+        if unsupported:
+            parser.error(f"--batch cannot be combined with {', '.join(unsupported)}")
 
     module_paths = [Path(p) for p in args.modules]
     test_path = Path(args.test)
-    semantic_path = Path(args.semantics)
-    changes_file = Path(args.changes_file)
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
     module_codes = [read_file(f) for f in module_paths]
     module_names = [f.name for f in module_paths]
-    semantic_prompt = read_file(semantic_path)
-    module_prompt = build_module_prompt(module_codes, module_names, semantic_prompt)
-    changes_lines = load_prompt_lines(changes_file)
+    module_sources = {f.stem: code for f, code in zip(module_paths, module_codes)}
+    if args.minify != "none":
+        compact_codes = [minify_module_source(code, args.minify) for code in module_codes]
+        for name, code, compact in zip(module_names, module_codes, compact_codes):
+            before, after = estimate_tokens(code), estimate_tokens(compact)
+            print(f"Minified {name}: ~{before} -> ~{after} tokens (saved ~{before - after}, {1 - after / before:.0%})")
+        module_codes = compact_codes
+    semantic_prompt = read_file(Path(args.semantics)) if args.semantics else ""
+    if args.auto_semantics:
+        generated = load_module_semantics(dict(zip(module_names, module_codes)), Path(args.semantics_cache_dir))
+        semantic_prompt = f"{semantic_prompt}\n\n{generated}".strip()
+    context_slicer = None
+    if args.slice_context:
+        # Only the semantics stay in the shared system prompt; each request
+        # carries the slice of module code its test actually uses.
+        context_slicer = ContextSlicer(dict(zip(module_names, module_codes)))
+        module_prompt = (f"I will provide unit tests targeting {len(module_codes)} Python modules "
+                         f"({', '.join(module_names)}), each together with the parts of the modules it uses.\n\n"
+                         f"{semantic_prompt}\n\n")
+    else:
+        module_prompt = build_module_prompt(module_codes, module_names, semantic_prompt)
+
+    if not test_path.is_dir():
+        import_block = extract_imports(read_file(test_path))
+        test_cases = extract_test_cases(read_file(test_path))
 
-    import_block = extract_imports(read_file(test_path))
-    test_cases = extract_test_cases(read_file(test_path))
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(Path(args.cache_dir), args.cache_max_mb * 1024 * 1024)
+        if args.clear_cache:
+            cache.clear()
+
+    pool_size = args.pool_size or max(10, 2 * args.max_in_flight * max(1, args.candidates))
+    http_client, connection_stats = shared_http_client(max_connections=pool_size, max_keepalive=pool_size,
+                                                       keepalive_expiry=args.keepalive_expiry,
+                                                       http2=args.http2,
+                                                       connect_timeout=args.connect_timeout,
+                                                       read_timeout=args.read_timeout)
 
     # Before execution, must complete api-key value.
     agent = TestImprovementAgent(api_key="",
                                  module_prompt=module_prompt,
-                                 model="gpt-4o")
-
-    for step_idx, change_prompt in enumerate(changes_lines, start=1):
-        improved_tests = []
+                                 model=args.model,
+                                 rpm=args.rpm,
+                                 tpm=args.tpm,
+                                 max_concurrency=args.max_in_flight if args.adaptive else 0,
+                                 cache=cache,
+                                 base_url=args.base_url,
+                                 context_slicer=context_slicer,
+                                 candidates=args.candidates,
+                                 candidate_mode=args.candidate_mode,
+                                 hedging=HedgePolicy(args.hedge_quantile, args.hedge_max_ratio)
+                                 if args.hedge_quantile > 0 else None,
+                                 retry=RetryPolicy(max_retries=args.max_retries, deadline=args.call_deadline),
+                                 breaker=CircuitBreaker(cooldown=args.breaker_cooldown),
+                                 http_client=http_client,
+                                 stream=args.stream)
 
-        for i, test_case in enumerate(test_cases, start=1):
-            print(f"[Step {step_idx}] Processing test {i}/{len(test_cases)}...")
-            improved = agent.improve_test(test_case, change_prompt, True)
-            improved_tests.append(improved)
-            time.sleep(1.5)
+    if context_slicer is not None and not test_path.is_dir() and test_cases:
+        full = sum(estimate_tokens(code) for code in module_codes)
+        sliced = sum(estimate_tokens(context_slicer.context_for(tc)) for tc in test_cases) / len(test_cases)
+        print(f"Context slicing: ~{sliced:.0f} module tokens per test instead of ~{full}")
 
-        merged = "\n\n".join(improved_tests)
-        full_test_file = add_imports_to_tests(import_block, merged)
-        full_test_file = agent.improve_test(full_test_file, "", False)
-
-        output_path = output_dir / f"{test_path.stem}_improved{step_idx}.py"
-        write_file(output_path, full_test_file)
-        print(f"✓ Output file: {output_path.name}")
-
-        test_cases = extract_test_cases(full_test_file)
+    if test_path.is_dir():
+        # Parse the whole directory up front (in parallel), then improve file by
+        # file. Outputs mirror the directory layout, so files that share a name
+        # in different subdirectories keep separate outputs and journals.
+        for path, parsed in parse_test_directory(test_path).items():
+            if parsed is None:
+                code = read_file(path)
+                import_block, file_tests = extract_imports(code), extract_test_cases(code)
+            else:
+                import_block, file_tests = parsed[0], [u.source for u in parsed[1]]
+            print(f"=== {path} ({len(file_tests)} tests) ===")
+            file_output_dir = output_dir / path.parent.relative_to(test_path)
+            file_output_dir.mkdir(parents=True, exist_ok=True)
+            improve_test_file(agent, path, import_block, file_tests, changes_lines, file_output_dir,
+                              module_sources, args)
+    else:
+        improve_test_file(agent, test_path, import_block, test_cases, changes_lines, output_dir,
+                          module_sources, args)
 
+    print(f"Total usage: {agent.usage_report()}")
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
+    if agent.hedging is not None:
+        print(f"Hedging: {agent.hedging.stats()}")
+    print(f"HTTP connections: {connection_stats.report()}")
+    if args.stream:
+        print(f"Streaming: {agent.stream_stats.report()}")
     print("✅ Finished!")
 
 
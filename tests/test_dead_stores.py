@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent_runner import remove_dead_stores
+
+
+def test_unread_store_is_removed():
+    code = "def test_a():\n    x = 1\n    y = 2\n    assert y == 2\n"
+    assert remove_dead_stores(code) == "def test_a():\n    y = 2\n    assert y == 2\n"
+
+
+def test_augmented_assignment_reads_the_store():
+    code = "def test_a():\n    x = 1\n    x += 2\n"
+    assert remove_dead_stores(code) == code
+
+
+def test_del_reads_the_store():
+    code = "def test_a():\n    x = 1\n    del x\n"
+    assert remove_dead_stores(code) == code
+
+
+def test_global_store_is_kept():
+    code = "def test_a():\n    global G\n    G = 3\n"
+    assert remove_dead_stores(code) == code
+
+
+def test_nonlocal_store_is_kept():
+    code = "def test_a():\n    x = 0\n    def inner():\n        nonlocal x\n        x = 1\n    inner()\n    assert x == 1\n"
+    assert remove_dead_stores(code) == code
+
+
+def test_locals_keeps_every_store():
+    code = "def test_a():\n    x = 1\n    assert 'x' in locals()\n"
+    assert remove_dead_stores(code) == code
+
+
+def test_vars_keeps_every_store():
+    code = "def test_a():\n    x = 1\n    assert vars()['x'] == 1\n"
+    assert remove_dead_stores(code) == code
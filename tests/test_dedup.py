@@ -0,0 +1,29 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent_runner import replay_rewrite, test_shape as shape_of
+
+REP = "def test_a():\n    int_0 = 1256\n    q = Queue(int_0)\n    assert q.capacity == 1256\n"
+MEMBER = "def test_b():\n    int_0 = -726\n    q = Queue(int_0)\n    assert q.capacity == -726\n"
+
+
+def replay(rep_output):
+    return replay_rewrite(shape_of(REP), rep_output, shape_of(MEMBER))
+
+
+def test_literals_and_names_are_replayed():
+    output = "def test_a():\n    # Intent: queue with the given capacity\n    capacity = 1256\n    q = Queue(capacity)\n    assert q.capacity == 1256\n"
+    assert replay(output) == ("def test_b():\n    # Intent: queue with the given capacity\n    capacity = -726\n"
+                              "    q = Queue(capacity)\n    assert q.capacity == -726")
+
+
+def test_comment_with_representative_value_is_not_replayed():
+    output = "def test_a():\n    # Intent: queue with capacity 1256\n    int_0 = 1256\n    q = Queue(int_0)\n    assert q.capacity == 1256\n"
+    assert replay(output) is None
+
+
+def test_new_name_with_representative_value_is_not_replayed():
+    output = "def test_a():\n    capacity_1256 = 1256\n    q = Queue(capacity_1256)\n    assert q.capacity == 1256\n"
+    assert replay(output) is None
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent_runner import apply_edit_ops
+
+CODE = ("def test_case_0():\n"
+        "    int_0 = 3\n"
+        "    queue_0 = module_0.Queue(int_0)\n"
+        "    assert queue_0.max == int_0\n")
+
+
+def edit(**ops):
+    return apply_edit_ops(CODE, {"renames": {}, "delete_lines": set(), "replace_lines": {}, "insert_after": {}, **ops})
+
+
+def test_rename_of_local_names():
+    assert edit(renames={"int_0": "capacity", "queue_0": "queue"}) == (
+        "def test_case_0():\n"
+        "    capacity = 3\n"
+        "    queue = module_0.Queue(capacity)\n"
+        "    assert queue.max == capacity")
+
+
+def test_rename_of_name_bound_outside_the_test_is_rejected():
+    assert edit(renames={"module_0": "m"}) is None
+
+
+def test_rename_onto_used_name_is_rejected():
+    assert edit(renames={"int_0": "queue_0"}) is None
+
+
+def test_two_names_renamed_to_one_is_rejected():
+    assert edit(renames={"int_0": "x", "queue_0": "x"}) is None
+
+
+def test_deleting_the_only_binding_is_rejected():
+    assert edit(delete_lines={2}) is None
+
+
+def test_deleting_an_unused_line_is_accepted():
+    assert edit(delete_lines={4}) == "def test_case_0():\n    int_0 = 3\n    queue_0 = module_0.Queue(int_0)"
@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent_runner import extend_import_block
+
+
+def test_new_imports_go_after_the_last_import():
+    preamble = "import pytest\n\n@pytest.fixture\ndef q():\n    return 1"
+    assert extend_import_block(preamble, {"import re"}) == (
+        "import pytest\nimport re\n\n@pytest.fixture\ndef q():\n    return 1")
+
+
+def test_new_imports_go_after_the_docstring_without_imports():
+    assert extend_import_block('"""Tests."""\nX = 1', {"import re"}) == '"""Tests."""\nimport re\nX = 1'
+
+
+def test_known_imports_are_not_repeated():
+    assert extend_import_block("import re", {"import re"}) == "import re"
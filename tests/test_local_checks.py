@@ -0,0 +1,23 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent_runner import fuse_step_prompts, passes_local_checks
+
+ORIGINAL = "def test_a():\n    d = f()\n    assert d['a'] == 1\n    assert d['b'] == 2\n"
+MERGED = "def test_a():\n    d = f()\n    assert d == {'a': 1, 'b': 2}\n"
+AAA = "Structure each test with # Arrange, # Act and # Assert comments."
+DICT_ASSERTS = "Replace per-key checks with dict-level asserts."
+
+
+def test_merged_asserts_rejected_without_dict_step():
+    assert not passes_local_checks(ORIGINAL, MERGED, AAA)
+
+
+def test_merged_asserts_accepted_for_dict_step():
+    assert passes_local_checks(ORIGINAL, MERGED, DICT_ASSERTS)
+
+
+def test_merged_asserts_accepted_for_fused_group_with_dict_step():
+    assert passes_local_checks(ORIGINAL, MERGED, fuse_step_prompts([AAA, DICT_ASSERTS], False))
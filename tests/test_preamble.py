@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from agent_runner import add_imports_to_tests, extract_test_cases, merge_preamble
+
+PREAMBLE = "import pytest\nfrom queue_example import Queue"
+
+
+def test_new_helper_is_kept_for_the_next_step():
+    step_output = add_imports_to_tests(PREAMBLE, "def _make():\n    return Queue(3)\n\n\ndef test_a():\n    assert _make()")
+    assert extract_test_cases(step_output) == ["def test_a():\n    assert _make()"]
+    assert merge_preamble(PREAMBLE, step_output) == PREAMBLE + "\n\ndef _make():\n    return Queue(3)"
+
+
+def test_new_import_joins_the_imports():
+    step_output = add_imports_to_tests(PREAMBLE, "import re\n\n\ndef test_a():\n    assert re.match('a', 'a')")
+    assert merge_preamble(PREAMBLE, step_output) == PREAMBLE + "\nimport re"
+
+
+def test_known_definitions_are_not_duplicated():
+    preamble = PREAMBLE + "\n\nCAPACITY = 3"
+    step_output = add_imports_to_tests(preamble, "CAPACITY = 4\n\n\ndef test_a():\n    assert CAPACITY")
+    assert merge_preamble(preamble, step_output) == preamble